@@ -1,14 +1,151 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-from datetime import datetime, timedelta
+from datetime import datetime
+from collections import OrderedDict
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+import pickle
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
 import warnings
 
 warnings.filterwarnings('ignore')
 
+
+class LazyModule:
+    """首次访问属性时才导入的模块代理，用于推迟图表、科学计算等较重模块的导入"""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+# 图表库较重，首次渲染图表时才导入，缩短打开页面到出现密码框的时间
+px = LazyModule("plotly.express")
+go = LazyModule("plotly.graph_objects")
+
+# Polars为可选依赖，仅在选择polars计算引擎时导入
+POLARS_AVAILABLE = importlib.util.find_spec("polars") is not None
+pl = LazyModule("polars")
+
+# 科学计算库仅在衰减结转、物料推荐等分析中使用
+scipy_signal = LazyModule("scipy.signal")
+scipy_sparse = LazyModule("scipy.sparse")
+
+# 读取Excel时已依赖openpyxl，导出XLSX时使用其只写模式
+openpyxl = LazyModule("openpyxl")
+
+# 本脚本启动时不应直接导入的模块，导入耗时分析会检查这些模块是否被提前导入
+DEFERRED_MODULES = ["plotly", "scipy", "polars"]
+
+# 分析计算引擎：pandas（默认）或 polars，可通过环境变量 DASHBOARD_ENGINE 配置
+ANALYSIS_ENGINE = os.environ.get("DASHBOARD_ENGINE", "pandas").strip().lower()
+
+# 数据集注册表：按年份/时期列出各分区的数据源文件，新增数据只需修改注册表
+DATASET_REGISTRY = os.environ.get("DASHBOARD_DATASETS", "datasets.json")
+
+# 列式存储目录：预处理后的数据按列写入本地磁盘，各服务进程以只读内存映射方式共享；设为空字符串则禁用
+COLUMN_STORE_DIR = os.environ.get("DASHBOARD_COLUMN_STORE", ".column_store")
+# 预处理逻辑或存储格式变化时递增，使旧的列式存储失效
+COLUMN_STORE_VERSION = 3
+
+# 后台检查数据源文件是否变化的间隔（秒）
+REFRESH_INTERVAL = int(os.environ.get("DASHBOARD_REFRESH_INTERVAL", "60"))
+
+# 分析结果磁盘缓存（SQLite），服务重启后仍然有效；设为空字符串则禁用
+RESULT_CACHE_PATH = os.environ.get("DASHBOARD_RESULT_CACHE", ".result_cache.sqlite")
+# 磁盘缓存容量上限（MB），超出后按最近最少使用淘汰
+# 分析结果的格式或计算逻辑变化时递增。结果键同时包含本脚本源码的哈希，部署新代码后旧结果自动失效
+RESULT_CACHE_VERSION = 1
+RESULT_CACHE_MAX_MB = float(os.environ.get("DASHBOARD_RESULT_CACHE_MB", "256"))
+# 表格导出文件目录：同一数据版本和筛选条件下的导出文件只生成一次，数据刷新后删除旧版本的导出文件
+EXPORT_DIR = os.environ.get("DASHBOARD_EXPORT_DIR", ".exports")
+# 导出时每次写入的行数，写出器的内存占用只与块大小有关，与总行数无关
+EXPORT_CHUNK_ROWS = 50_000
+# Excel单个工作表的最大行数（含表头），超出时续写到新的工作表
+XLSX_MAX_ROWS = 1_048_576
+# 图表联动筛选的维度：{列名: 显示名称}。点击区域销售柱形图或客户ROI矩阵后，其他分析按所选取值筛选
+CROSS_FILTER_COLUMNS = {'所属区域': '区域', '客户代码': '客户'}
+# 产生联动筛选的图表：{图表key: 筛选列}
+CROSS_FILTER_CHARTS = {'chart_region_sales': '所属区域', 'chart_customer_roi': '客户代码'}
+# 透视分析的维度：{名称: 所在数据}。'共有'维度在物料和销售数据中都存在，可以同时汇总物料和销售指标
+PIVOT_DIMENSIONS = {
+    '所属区域': '共有', '省份': '共有', '城市': '共有', '申请人': '共有',
+    '物料类别': '物料', '物料名称': '物料', '产品名称': '销售',
+    '月': '共有', '季度': '共有', '年': '共有'
+}
+# 透视分析的时间维度：{名称: pandas周期频率}
+PIVOT_TIME_DIMENSIONS = {'月': 'M', '季度': 'Q', '年': 'Y'}
+# 透视分析的指标：{名称: 需要的数据}
+PIVOT_MEASURES = {'物料数量': '物料', '物料总成本': '物料', '销售总额': '销售', '费比': '共有', 'ROI': '共有'}
+# 去重计数存储的单元格：每个 (区域, 省份, 月份, 申请人, 物料) 组合分别保存客户和物料的去重集合及HyperLogLog草图，
+# 任意筛选条件下的去重客户数、物料种类数由所选单元格合并得到
+DISTINCT_CELL_COLUMNS = ['所属区域', '省份', '发运月份', '申请人', '物料名称']
+# 需要去重计数的列
+DISTINCT_COLUMNS = ['客户代码', '物料名称']
+# HyperLogLog精度：每个草图 2^HLL_PRECISION 个寄存器，相对误差约 1.04 / sqrt(2^HLL_PRECISION)
+HLL_PRECISION = 10
+# 默认的去重计数方式：approx（HyperLogLog近似）或 exact（精确集合），可在侧边栏切换
+DISTINCT_MODE = os.environ.get("DASHBOARD_DISTINCT", "approx").strip().lower()
+# 分页表格每页可选的行数
+TABLE_PAGE_SIZES = [20, 50, 100]
+# 进程内分析结果缓存容量上限（MB），超出后按最近最少使用淘汰；设为0则禁用
+RESULT_MEMO_MAX_MB = float(os.environ.get("DASHBOARD_MEMO_MB", "128"))
+
+# 时间序列存储的粒度：{名称: (pandas周期频率, 相邻周期间隔)}。源数据按月记录，最细只能到月
+TIME_SERIES_RESOLUTIONS = {
+    '月': ('M', pd.DateOffset(months=1)),
+    '季度': ('Q', pd.DateOffset(months=3)),
+    '年': ('Y', pd.DateOffset(years=1))
+}
+# 时间序列存储的维度：{名称: 分组列}，第一列为维度值，第二列（如有）为显示名称
+TIME_SERIES_DIMENSIONS = {
+    '整体': [],
+    '区域': ['所属区域'],
+    '省份': ['省份'],
+    '客户': ['客户代码', '经销商名称'],
+    '物料': ['物料代码', '物料名称']
+}
+# 移动平均的窗口（周期数）
+ROLLING_WINDOW = 3
+
+# 自助法（bootstrap）置信区间的重抽样次数和随机种子（固定种子保证每次结果一致，也便于缓存）
+BOOTSTRAP_SAMPLES = 1000
+BOOTSTRAP_SEED = 2025
+# 每批重抽样的索引矩阵最多包含的元素数，控制内存占用
+BOOTSTRAP_BATCH_CELLS = 4_000_000
+
+# 异常检测：稳健Z值（基于中位数和MAD）绝对值超过该阈值的月份视为异常
+ANOMALY_Z_THRESHOLD = 3.5
+# 异常检测：对象至少有这么多个月的有效数据才参与检测
+ANOMALY_MIN_MONTHS = 6
+# 异常检测的对象维度：{名称: 分组列}
+ANOMALY_DIMENSIONS = {'客户': '客户代码', '申请人': '申请人', '省份': '省份'}
+
+# 物料推荐：每个客户推荐的物料数
+RECOMMENDATION_TOP_N = 10
+
+# 预算优化：每个物料×区域的响应曲线切分成的线性段数
+BUDGET_SEGMENTS = 10
+# 预算优化：每个物料×区域的建议投入默认不超过当前投入的倍数
+BUDGET_MAX_MULTIPLE = 2.0
+
+# 衰减结转（Adstock）归因中各物料类别每月的默认留存比例：陈列物料摆放时间长，效果衰减慢
+ADSTOCK_DECAY = {'陈列物料': 0.6, '促销物料': 0.3}
+# 未在ADSTOCK_DECAY中列出的物料类别使用的留存比例
+ADSTOCK_DEFAULT_DECAY = 0.5
+
 # 设置页面配置
 st.set_page_config(
     page_title="口力营销物料与销售分析仪表盘",
@@ -68,28 +205,793 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
-# 加载数据
-@st.cache_data(ttl=3600)
-def load_data():
-    """加载Excel数据文件"""
+# 冻结数据框
+def freeze_frame(df):
+    """重建为每列一个只读NumPy数组的数据框，供所有会话共享，任何原地修改都会直接报错"""
+    columns = {}
+    for col in df.columns:
+        values = df[col].to_numpy(copy=True)
+        values.flags.writeable = False
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+# 数据源指纹
+def source_fingerprint(paths):
+    """根据数据源文件的大小和修改时间生成指纹，源文件变化后对应新的列式存储目录"""
+    digest = hashlib.sha1(f"v{COLUMN_STORE_VERSION}".encode('utf-8'))
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+# 写入列式存储
+def write_column_store(store_path, frames):
+    """把预处理后的数据逐列写成.npy文件：数值和日期列原样保存，文本列保存为字典编码。
+    先写入临时目录再整体改名，多个进程同时构建时只有一个生效"""
+    tmp_path = f"{store_path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+
+    manifest = {}
+    for frame_name, df in frames.items():
+        columns = []
+        for i, col in enumerate(df.columns):
+            file_base = f"{frame_name}_{i}"
+            if df[col].dtype.kind in 'biufM':
+                np.save(os.path.join(tmp_path, f"{file_base}.npy"), df[col].to_numpy())
+                kind = 'array'
+            else:
+                codes, categories = pd.factorize(df[col])
+                np.save(os.path.join(tmp_path, f"{file_base}.npy"), codes.astype(np.int32))
+                np.save(os.path.join(tmp_path, f"{file_base}_categories.npy"),
+                        np.asarray(categories, dtype=object), allow_pickle=True)
+                kind = 'dictionary'
+            columns.append({'name': col, 'kind': kind, 'file': file_base})
+        manifest[frame_name] = columns
+
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
     try:
-        # 尝试加载真实数据
-        material_file = "2025物料源数据.xlsx"
-        sales_file = "25物料源销售数据.xlsx"
-        price_file = "物料单价.xlsx"
+        os.rename(tmp_path, store_path)
+    except OSError:
+        # 其他进程已先完成构建，直接使用已有的存储
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# 打开列式存储
+def open_column_store(store_path):
+    """以只读内存映射方式打开列式存储，存储不存在时返回None。
+    数值和日期列直接映射磁盘文件，多个进程共享操作系统页缓存"""
+    manifest_file = os.path.join(store_path, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return None
+
+    with open(manifest_file, encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    frames = {}
+    for frame_name, columns in manifest.items():
+        data = {}
+        for column in columns:
+            path = os.path.join(store_path, column['file'])
+            values = np.load(f"{path}.npy", mmap_mode='r').view(np.ndarray)
+            if column['kind'] == 'dictionary':
+                # 编码-1表示缺失值，正好取到末尾追加的NaN
+                categories = np.append(np.load(f"{path}_categories.npy", allow_pickle=True), np.nan)
+                values = categories[values]
+                values.flags.writeable = False
+            data[column['name']] = values
+        frames[frame_name] = pd.DataFrame(data, copy=False)
+    return frames
+
+
+# 清理旧的列式存储
+def remove_stale_column_stores(keep_versions):
+    """删除不属于当前任何分区版本的旧存储目录（仍被其他进程映射的文件由操作系统延迟释放）"""
+    if not os.path.isdir(COLUMN_STORE_DIR):
+        return
+    for name in os.listdir(COLUMN_STORE_DIR):
+        if name not in keep_versions and '.tmp-' not in name:
+            shutil.rmtree(os.path.join(COLUMN_STORE_DIR, name), ignore_errors=True)
+
+
+# 清理过期的导出文件
+def remove_stale_exports(keep_versions):
+    """删除依赖了keep_versions以外分区版本的导出文件目录（目录名为数据版本，即所选分区版本以'+'连接）"""
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    for name in os.listdir(EXPORT_DIR):
+        if not set(name.split('+')) <= keep_versions:
+            shutil.rmtree(os.path.join(EXPORT_DIR, name), ignore_errors=True)
+
+
+# 读取数据集注册表
+def load_dataset_registry(path=None):
+    """读取数据集注册表（JSON）。格式：
+    {"price_file": 单价文件,
+     "partitions": [{"name": 分区名, "start": "YYYY-MM", "end": "YYYY-MM",
+                     "material_file": 物料文件, "sales_file": 销售文件}, ...]}
+    start/end为该分区覆盖的发运月份范围，返回的分区按起始月份排序"""
+    path = path or DATASET_REGISTRY
+    with open(path, encoding='utf-8') as f:
+        registry = json.load(f)
+
+    partitions = []
+    for item in registry['partitions']:
+        partitions.append({
+            'name': str(item['name']),
+            'start': pd.Timestamp(item['start']).date(),
+            'end': pd.Timestamp(item['end']).date(),
+            'material_file': item['material_file'],
+            'sales_file': item['sales_file']
+        })
+    if not partitions:
+        raise ValueError("数据集注册表中没有任何分区")
+    partitions.sort(key=lambda partition: partition['start'])
+    return {'path': path, 'price_file': registry['price_file'], 'partitions': partitions}
+
+
+# 注册表涉及的文件
+def registry_files(registry):
+    """返回注册表本身以及所有分区的数据源文件，后台刷新器监视这些文件的变化"""
+    files = [registry['path'], registry['price_file']]
+    for partition in registry['partitions']:
+        files.extend([partition['material_file'], partition['sales_file']])
+    return files
+
+
+# 选择分区
+def select_partitions(registry, start_date, end_date):
+    """返回发运月份范围与所选日期范围有重叠的分区名"""
+    return [
+        partition['name'] for partition in registry['partitions']
+        if partition['start'] <= end_date and partition['end'] >= start_date
+    ]
+
+
+# 默认分区
+def default_partitions(registry):
+    """侧边栏默认只选择最新的分区"""
+    latest = max(registry['partitions'], key=lambda partition: partition['end'])
+    return [latest['name']]
+
+
+# 构建分区数据
+def build_partition(partition, version, price_file):
+    """优先以只读方式映射该分区当前版本的列式存储，不存在时解析Excel并写入列式存储，供其他服务进程直接使用"""
+    store_path = None
+    if COLUMN_STORE_DIR and version:
+        try:
+            store_path = os.path.join(COLUMN_STORE_DIR, version)
+            frames = open_column_store(store_path)
+            if frames is not None:
+                return frames['material'], frames['sales'], frames['price']
+        except (OSError, ValueError, KeyError):
+            store_path = None
+
+    df_material, df_sales, df_material_price = read_source_data(
+        partition['material_file'], partition['sales_file'], price_file
+    )
+    if df_material is None:
+        return None, None, None
+
+    if store_path:
+        try:
+            os.makedirs(COLUMN_STORE_DIR, exist_ok=True)
+            write_column_store(store_path, {
+                'material': df_material,
+                'sales': df_sales,
+                'price': df_material_price
+            })
+            frames = open_column_store(store_path)
+            return frames['material'], frames['sales'], frames['price']
+        except (OSError, ValueError, KeyError) as e:
+            st.warning(f"写入列式存储失败，将直接使用内存中的数据: {e}")
+
+    return freeze_frame(df_material), freeze_frame(df_sales), freeze_frame(df_material_price)
+
+
+class DataSnapshot:
+    """某一时刻的数据快照。分区在首次被用到时才加载（映射其列式存储），加载后在快照内共享；
+    多个分区的组合也只拼接一次。results为默认视图的预热结果"""
+
+    def __init__(self, registry, version, partition_versions, source_time):
+        self.registry = registry
+        self.version = version
+        self.partition_versions = partition_versions
+        self.source_time = source_time
+        self.loaded_at = datetime.now()
+        self.results = {}
+        self._partitions = {}
+        self._combined = {}
+        self._partition_results = {}
+        self._lock = threading.Lock()
+
+    @property
+    def partition_names(self):
+        """全部分区名（按起始月份排序）"""
+        return [partition['name'] for partition in self.registry['partitions']]
+
+    def dataset_version(self, names):
+        """所选分区组合的数据版本，只随这些分区的数据源变化"""
+        return '+'.join(str(self.partition_versions.get(name)) for name in names)
+
+    def partition(self, name):
+        """返回单个分区的(物料, 销售, 单价)数据，首次调用时加载"""
+        with self._lock:
+            if name not in self._partitions:
+                partition = next(p for p in self.registry['partitions'] if p['name'] == name)
+                self._partitions[name] = build_partition(
+                    partition, self.partition_versions.get(name), self.registry['price_file']
+                )
+            return self._partitions[name]
+
+    def quality_report(self, name):
+        """返回单个分区的数据质量报告，分区加载失败时返回None"""
+        return self._partition_result(name, 'quality', profile_data_quality)
+
+    def time_series_store(self, name):
+        """返回单个分区的多粒度时间序列存储，分区加载失败时返回None"""
+        return self._partition_result(name, 'time_series_store', build_time_series_store)
+
+    def distinct_store(self, name):
+        """返回单个分区的去重计数存储，分区加载失败时返回None"""
+        return self._partition_result(name, 'distinct_store', build_distinct_store)
+
+    def pivot_cube(self, name):
+        """返回单个分区的透视分析汇总数据，分区加载失败时返回None"""
+        return self._partition_result(name, 'pivot_cube', build_pivot_cube)
+
+    def prepare(self, name):
+        """加载单个分区并生成数据质量报告、时间序列存储、透视汇总和去重计数存储，
+        之后打开数据质量页或切换时间粒度时不需要再扫描明细数据"""
+        self.quality_report(name)
+        self.time_series_store(name)
+        self.pivot_cube(name)
+        self.distinct_store(name)
+
+    def _partition_result(self, name, step, compute):
+        """对单个分区的物料、销售数据调用compute，结果保存在快照中并按分区版本缓存到磁盘结果缓存"""
+        if (name, step) not in self._partition_results:
+            df_material, df_sales, _ = self.partition(name)
+            if df_material is None:
+                return None
+            self._partition_results[(name, step)] = cached_compute(
+                make_filter_key(self.dataset_version([name])), step,
+                lambda: compute(df_material, df_sales)
+            )
+        return self._partition_results[(name, step)]
+
+    def frames(self, names=None):
+        """返回所选分区合并后的(物料, 销售, 单价)数据，任一分区加载失败时返回(None, None, None)"""
+        names = tuple(self.partition_names if names is None else names)
+        parts = [self.partition(name) for name in names]
+        if not parts or any(part[0] is None for part in parts):
+            return None, None, None
+        if len(parts) == 1:
+            return parts[0]
+
+        with self._lock:
+            if names not in self._combined:
+                self._combined[names] = (
+                    freeze_frame(pd.concat([part[0] for part in parts], ignore_index=True)),
+                    freeze_frame(pd.concat([part[1] for part in parts], ignore_index=True)),
+                    parts[-1][2]
+                )
+            return self._combined[names]
+
 
+class DataRefresher:
+    """持有当前数据快照，并在后台线程中定期检查数据集注册表和数据源文件。
+    文件变化时在后台重建数据、预热默认视图并整体替换快照，重建期间用户继续看到旧快照，请求不会等待数据加载。
+    快照只准备默认分区，其余分区在请求的日期范围用到时才加载，未用到的分区不占用本进程的内存"""
+
+    def __init__(self, interval=REFRESH_INTERVAL):
+        self.interval = interval
+        self.refreshing = False
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        try:
+            self._snapshot = self._build()
+        except (OSError, ValueError, KeyError) as e:
+            st.error(f"无法读取数据集注册表 {DATASET_REGISTRY}: {e}")
+            self._snapshot = None
+        threading.Thread(target=self._watch, name="data-refresher", daemon=True).start()
+
+    def snapshot(self):
+        """返回当前数据快照"""
+        return self._snapshot
+
+    def refresh(self):
+        """重建数据并替换快照；已有刷新在进行时直接返回"""
+        if not self._lock.acquire(blocking=False):
+            return
+        self.refreshing = True
+        try:
+            snapshot = self._build()
+            if snapshot.frames(default_partitions(snapshot.registry))[0] is None:
+                self.last_error = "数据源解析失败"
+            else:
+                self._snapshot = snapshot
+                self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+        finally:
+            self.refreshing = False
+            self._lock.release()
+
+    def stop(self):
+        """停止后台检查"""
+        self._stopped.set()
+
+    def _build(self):
+        registry = load_dataset_registry()
+        partition_versions = {}
+        for partition in registry['partitions']:
+            try:
+                partition_versions[partition['name']] = source_fingerprint(
+                    [partition['material_file'], partition['sales_file'], registry['price_file']]
+                )
+            except OSError:
+                partition_versions[partition['name']] = None
+        try:
+            files = registry_files(registry)
+            version = source_fingerprint(files)
+            source_time = datetime.fromtimestamp(max(os.path.getmtime(path) for path in files[1:]))
+        except OSError:
+            version, source_time = None, None
+
+        snapshot = DataSnapshot(registry, version, partition_versions, source_time)
+        snapshot.results = warm_up(snapshot)
+        for name in default_partitions(registry):
+            snapshot.prepare(name)
+
+        if COLUMN_STORE_DIR:
+            remove_stale_column_stores(partition_versions.values())
+
+        result_cache = get_result_cache()
+        if result_cache is not None:
+            # 分区数据源变化后，依赖旧版本分区的分析结果全部失效
+            result_cache.purge(keep_versions={str(v) for v in partition_versions.values() if v})
+        remove_stale_exports({str(v) for v in partition_versions.values() if v})
+        return snapshot
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                registry = load_dataset_registry()
+                version = source_fingerprint(registry_files(registry))
+            except (OSError, ValueError, KeyError):
+                # 文件正在被替换或暂时缺失，下次再检查
+                continue
+            if self._snapshot is None or version != self._snapshot.version:
+                self.refresh()
+
+
+# 分析代码版本
+def code_version():
+    """RESULT_CACHE_VERSION加本脚本源码的哈希，计算函数有任何修改时都会变化"""
+    try:
+        with open(__file__, 'rb') as f:
+            source_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+    except (OSError, NameError):
+        source_hash = 'unknown'
+    return f"v{RESULT_CACHE_VERSION}-{source_hash}"
+
+
+RESULT_CODE_VERSION = code_version()
+
+
+# 分析结果键
+def result_key(filter_key, name):
+    """由代码版本、规范化的筛选键和分析名生成稳定的哈希键"""
+    return hashlib.sha1(repr((RESULT_CODE_VERSION, filter_key, name)).encode('utf-8')).hexdigest()
+
+
+# 估算结果占用内存
+def result_nbytes(result):
+    """估算分析结果（数据框或由数据框组成的元组）占用的字节数"""
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(index=True, deep=True).sum())
+    if isinstance(result, tuple):
+        return sum(result_nbytes(value) for value in result)
+    return sys.getsizeof(result)
+
+
+class ResultMemo:
+    """进程内的分析结果LRU缓存：按字节预算淘汰最久未使用的结果，并按分析名统计命中与未命中次数"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = {}
+        self.misses = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filter_key, name):
+        """读取结果并记录命中情况，未命中时返回None"""
+        key = result_key(filter_key, name)
+        label = str(name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses[label] = self.misses.get(label, 0) + 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits[label] = self.hits.get(label, 0) + 1
+            return entry[0]
+
+    def put(self, filter_key, name, result):
+        """保存结果，超出字节预算时淘汰最久未使用的结果；单个结果超过预算时不保存"""
+        size = result_nbytes(result)
+        if size > self.max_bytes:
+            return
+        key = result_key(filter_key, name)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+
+    def stats(self):
+        """返回 (条目数, 占用字节数, 总命中次数, 总未命中次数)"""
+        with self._lock:
+            return len(self._entries), self.nbytes, sum(self.hits.values()), sum(self.misses.values())
+
+
+# 获取进程内结果缓存
+@st.cache_resource
+def get_result_memo():
+    """每个服务进程只创建一个进程内结果缓存，所有会话共享"""
+    return ResultMemo(int(RESULT_MEMO_MAX_MB * 1024 * 1024))
+
+
+class ResultCache:
+    """基于SQLite的分析结果磁盘缓存：键为数据版本加规范化的筛选条件和分析名，
+    总大小超过上限时按最近最少使用淘汰，多个服务进程可共享同一个缓存文件"""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, version TEXT NOT NULL, payload BLOB NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+            # 代码版本变化（部署了新代码）时清空旧结果，与COLUMN_STORE_VERSION使旧列式存储失效的做法一致
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            row = conn.execute("SELECT value FROM meta WHERE name = 'code_version'").fetchone()
+            if row is None or row[0] != RESULT_CODE_VERSION:
+                conn.execute("DELETE FROM results")
+                conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('code_version', ?)",
+                             (RESULT_CODE_VERSION,))
+
+    def _connect(self):
+        # 每次操作使用独立连接，可在多个会话线程中安全调用
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, filter_key, name):
+        """读取缓存结果，未命中或读取失败时返回None"""
+        key = result_key(filter_key, name)
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT payload FROM results WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            return pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+    def put(self, filter_key, name, result):
+        """写入缓存结果并按容量上限淘汰最久未使用的条目，写入失败时忽略"""
+        try:
+            payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        if len(payload) > self.max_bytes:
+            return
+
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO results (key, version, payload, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (result_key(filter_key, name), str(filter_key[0]), payload, len(payload), time.time())
+                )
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+                if total > self.max_bytes:
+                    evict = []
+                    for key, size in conn.execute("SELECT key, size FROM results ORDER BY last_used"):
+                        if total <= self.max_bytes:
+                            break
+                        evict.append((key,))
+                        total -= size
+                    conn.executemany("DELETE FROM results WHERE key = ?", evict)
+        except sqlite3.Error:
+            pass
+
+    def purge(self, keep_versions):
+        """删除依赖了keep_versions以外分区版本的缓存结果（数据版本为所选分区版本以'+'连接）"""
+        try:
+            with self._connect() as conn:
+                versions = [row[0] for row in conn.execute("SELECT DISTINCT version FROM results")]
+                stale = [(version,) for version in versions if not set(version.split('+')) <= keep_versions]
+                conn.executemany("DELETE FROM results WHERE version = ?", stale)
+        except sqlite3.Error:
+            pass
+
+
+# 获取结果缓存
+@st.cache_resource
+def get_result_cache():
+    """每个服务进程只打开一个磁盘结果缓存，未启用或无法创建时返回None"""
+    if not RESULT_CACHE_PATH:
+        return None
+    try:
+        return ResultCache(RESULT_CACHE_PATH, int(RESULT_CACHE_MAX_MB * 1024 * 1024))
+    except sqlite3.Error:
+        return None
+
+
+# 带磁盘缓存的计算
+def cached_compute(filter_key, name, compute):
+    """先查磁盘缓存，未命中时调用compute()计算并写入缓存；数据版本未知时直接计算"""
+    result_cache = get_result_cache()
+    if result_cache is None or filter_key is None or not filter_key[0]:
+        return compute()
+
+    result = result_cache.get(filter_key, name)
+    if result is None:
+        result = compute()
+        result_cache.put(filter_key, name, result)
+    return result
+
+
+# 分块写出导出文件
+def write_export(frame, path, file_format):
+    """按EXPORT_CHUNK_ROWS分块把数据写入CSV或XLSX：CSV逐块追加，XLSX使用openpyxl只写模式逐行落盘，
+    超过单表行数上限时续写到新工作表。先写临时文件再改名，并发导出不会读到写了一半的文件"""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    chunks = (frame.iloc[start:start + EXPORT_CHUNK_ROWS] for start in range(0, len(frame), EXPORT_CHUNK_ROWS))
+    try:
+        if file_format == 'csv':
+            # 带BOM的UTF-8，Excel直接打开CSV时中文不乱码
+            with open(tmp_path, 'w', encoding='utf-8-sig', newline='') as f:
+                frame.head(0).to_csv(f, index=False)
+                for chunk in chunks:
+                    chunk.to_csv(f, index=False, header=False)
+        else:
+            workbook = openpyxl.Workbook(write_only=True)
+            sheet, sheet_rows = None, XLSX_MAX_ROWS
+            if frame.empty:
+                workbook.create_sheet().append([str(c) for c in frame.columns])
+            for chunk in chunks:
+                # 缺失值写为空单元格，numpy标量转换为Python对象
+                for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+                    if sheet_rows >= XLSX_MAX_ROWS:
+                        sheet = workbook.create_sheet()
+                        sheet.append([str(c) for c in frame.columns])
+                        sheet_rows = 1
+                    sheet.append(row)
+                    sheet_rows += 1
+            workbook.save(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# 获取导出文件
+def export_file(filter_key, name, frame, file_format):
+    """返回导出文件路径：文件按数据版本分目录、以筛选键和表名的哈希命名，已存在时直接复用"""
+    version = str(filter_key[0]) if filter_key and filter_key[0] else 'unversioned'
+    directory = os.path.join(EXPORT_DIR, version)
+    path = os.path.join(directory, f"{result_key(filter_key, ('export', name))}.{file_format}")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        write_export(frame, path, file_format)
+    return path
+
+
+# 导出按钮
+def export_buttons(name, frame, filter_key=None, key_prefix=''):
+    """显示CSV和XLSX下载按钮。文件在点击时才由Streamlit在后台线程生成，不阻塞页面，下载也不触发页面重新运行；
+    frame应为已缓存的汇总结果或已筛选的明细，导出时不再重新计算。导出文件分块写入磁盘，但下载时仍整体读入内存发送"""
+
+    def read_export(file_format):
+        with open(export_file(filter_key, name, frame, file_format), 'rb') as f:
+            return f.read()
+
+    with st.container(horizontal=True):
+        for file_format, mime in (
+            ('csv', 'text/csv'),
+            ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        ):
+            st.download_button(
+                f"导出{file_format.upper()}",
+                data=lambda file_format=file_format: read_export(file_format),
+                file_name=f"{name}.{file_format}",
+                mime=mime,
+                key=f"export_{key_prefix}{name}_{file_format}",
+                on_click='ignore'
+            )
+
+
+# 图表联动筛选
+def select_cross_filter(chart_key):
+    """图表选择变化时的回调：选中点的customdata第一项作为筛选值，取消选择时清除该维度的联动筛选"""
+    selection = st.session_state[chart_key].selection
+    values = sorted({str(point['customdata'][0]) for point in selection.get('points', []) if point.get('customdata')})
+    cross_filters = dict(st.session_state.get('cross_filters', {}))
+    if values:
+        cross_filters[CROSS_FILTER_CHARTS[chart_key]] = values
+    else:
+        cross_filters.pop(CROSS_FILTER_CHARTS[chart_key], None)
+    st.session_state['cross_filters'] = cross_filters
+
+
+def clear_cross_filters():
+    """清除所有联动筛选和图表上的选择"""
+    st.session_state['cross_filters'] = {}
+    for chart_key in CROSS_FILTER_CHARTS:
+        st.session_state.pop(chart_key, None)
+
+
+def cross_filter_key(filter_key, cross_filters, exclude=None):
+    """在侧边栏筛选键后追加联动筛选条件；没有联动筛选时返回原键，预热和缓存结果照常命中"""
+    active = tuple(
+        (column, tuple(sorted(values))) for column, values in sorted(cross_filters.items()) if column != exclude and values
+    )
+    if filter_key is None or not active:
+        return filter_key
+    return filter_key + (active,)
+
+
+def cross_filter_positions(filter_key, table, frame, column, values):
+    """返回frame中column取值属于values的行号（升序）。每列的 取值→行号 索引按筛选键缓存在进程内结果缓存中，
+    选择变化时只需取出所选取值对应的行号，不再扫描整列"""
+    memo = get_result_memo()
+    memo_name = ('cross_filter_index', table, column)
+    index = memo.get(filter_key, memo_name) if filter_key is not None else None
+    if index is None:
+        codes, uniques = pd.factorize(frame[column].astype(str).where(frame[column].notna()))
+        order = np.argsort(codes, kind='stable')
+        # 缺失值的编码为-1，排在最前面，跳过
+        order = order[(codes < 0).sum():]
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)))])
+        index = (pd.Index(uniques), order, bounds)
+        if filter_key is not None:
+            memo.put(filter_key, memo_name, index)
+
+    uniques, order, bounds = index
+    found = uniques.get_indexer(values)
+    found = found[found >= 0]
+    if len(found) == 0:
+        return np.empty(0, dtype=np.intp)
+    return np.sort(np.concatenate([order[bounds[i]:bounds[i + 1]] for i in found]))
+
+
+def apply_cross_filters(filter_key, table, frame, cross_filters, exclude=None):
+    """在侧边栏筛选结果上叠加联动筛选：各维度的行号求交集后一次取行，不重新执行filter_data。
+    exclude为产生筛选的图表自身的维度，该图表不按自己的选择筛选"""
+    positions = None
+    for column, values in sorted(cross_filters.items()):
+        if column == exclude or not values:
+            continue
+        rows = cross_filter_positions(filter_key, table, frame, column, values)
+        positions = rows if positions is None else np.intersect1d(positions, rows, assume_unique=True)
+    return frame if positions is None else frame.take(positions)
+
+
+def display_cross_filters(df_material):
+    """在侧边栏列出生效的联动筛选并提供清除按钮，返回 {列名: 取值列表}"""
+    cross_filters = {column: values for column, values in st.session_state.get('cross_filters', {}).items() if values}
+    if not cross_filters:
+        return {}
+
+    names = {}
+    if '客户代码' in cross_filters:
+        customers = df_material.loc[df_material['客户代码'].isin(cross_filters['客户代码']), ['客户代码', '经销商名称']]
+        names = dict(customers.drop_duplicates('客户代码').itertuples(index=False, name=None))
+    with st.sidebar:
+        st.markdown("**图表联动筛选**")
+        for column, values in cross_filters.items():
+            labels = [str(names.get(value, value)) for value in values]
+            more = f" 等{len(labels)}个" if len(labels) > 10 else ""
+            st.caption(f"{CROSS_FILTER_COLUMNS[column]}：{'、'.join(labels[:10])}{more}")
+        st.button("清除图表筛选", on_click=clear_cross_filters)
+    return cross_filters
+
+
+# 表格排序索引
+def table_order(filter_key, name, frame, column, query='', search_columns=()):
+    """返回 (行号, 有效行数)：行号按column升序排列、缺失值在最后，query非空时只保留search_columns中包含query的行。
+    结果按筛选键、表名、排序列和搜索词缓存在进程内结果缓存中，翻页和切换升降序不再重新排序"""
+    memo = get_result_memo()
+    memo_name = ('table_order', name, column, query)
+    result = memo.get(filter_key, memo_name) if filter_key is not None else None
+    if result is None:
+        values = frame[column].reset_index(drop=True)
+        order = values.sort_values(kind='stable', na_position='last').index.to_numpy()
+        valid = values.notna().to_numpy()
+        if query:
+            match = np.zeros(len(frame), dtype=bool)
+            for search_column in search_columns:
+                match |= frame[search_column].astype(str).str.contains(query, case=False, regex=False).to_numpy()
+            order = order[match[order]]
+        result = (order, int(valid[order].sum()))
+        if filter_key is not None:
+            memo.put(filter_key, memo_name, result)
+    return result
+
+
+# 分页表格
+def paginated_table(name, frame, filter_key=None, search_columns=(), formats=None, default_sort=None):
+    """可搜索、可排序的分页表格：排序使用table_order缓存的行号，每次只取当前页的行发送到浏览器，
+    翻页的开销与总行数无关"""
+    cols = st.columns([3, 2, 2, 1])
+    with cols[0]:
+        query = st.text_input("搜索:", key=f"table_query_{name}",
+                              placeholder="、".join(search_columns)).strip() if search_columns else ''
+    with cols[1]:
+        columns = list(frame.columns)
+        sort_column = st.selectbox("排序字段:", columns, key=f"table_sort_{name}",
+                                   index=columns.index(default_sort) if default_sort in columns else 0)
+    with cols[2]:
+        descending = st.radio("排序方式:", ["降序", "升序"], horizontal=True, key=f"table_desc_{name}") == "降序"
+    with cols[3]:
+        page_size = st.selectbox("每页行数:", TABLE_PAGE_SIZES, key=f"table_size_{name}")
+
+    order, n_valid = table_order(filter_key, name, frame, sort_column, query, search_columns)
+    total = len(order)
+    pages = max((total + page_size - 1) // page_size, 1)
+    # 结果行数变化时重置页码，避免页码超出范围
+    page = st.number_input(f"页码（共 {pages} 页，{total:,} 行）:", min_value=1, max_value=pages, value=1,
+                           key=f"table_page_{name}_{total}_{page_size}")
+
+    # 降序时有效值倒序排列、缺失值仍在最后，直接按位置换算出当前页的行号
+    positions = np.arange((page - 1) * page_size, min(page * page_size, total))
+    if descending:
+        positions = np.where(positions < n_valid, n_valid - 1 - positions, positions)
+    st.dataframe(frame.iloc[order[positions]].style.format(formats or {}, na_rep='-'),
+                 use_container_width=True, hide_index=True)
+
+
+# 获取数据刷新器
+@st.cache_resource
+def get_data_refresher():
+    """每个服务进程只创建一个数据刷新器，首次调用时同步加载数据"""
+    return DataRefresher()
+
+
+# 读取数据源
+def read_source_data(material_file, sales_file, price_file):
+    """解析一个分区的Excel数据文件并完成预处理"""
+    try:
+        # 尝试加载真实数据
         df_material = pd.read_excel(material_file)
         df_sales = pd.read_excel(sales_file)
         df_material_price = pd.read_excel(price_file)
 
         # 处理物料单价表 - 检测到重复的"物料类别"列
         if '物料代码' in df_material_price.columns and '单价（元）' in df_material_price.columns:
-            df_material_price = df_material_price[['物料代码', '单价（元）']]
+            df_material_price = prepare_price_history(df_material_price)
         else:
             # 根据您提供的数据结构，实际上是第二列和第四列
             try:
                 df_material_price.columns = ['物料类别1', '物料代码', '物料类别2', '单价（元）']
-                df_material_price = df_material_price[['物料代码', '单价（元）']]
+                df_material_price = prepare_price_history(df_material_price)
             except:
                 st.error("物料单价表结构与预期不符，请检查数据")
                 return None, None, None
@@ -138,12 +1040,12 @@ def load_data():
                 st.error("销售数据日期格式无法解析")
                 return None, None, None
 
-    # 2. 将物料单价添加到物料数据中
-    material_price_dict = dict(zip(df_material_price['物料代码'], df_material_price['单价（元）']))
-    df_material['物料单价'] = df_material['物料代码'].map(material_price_dict)
-    df_material['物料单价'].fillna(0, inplace=True)
+    # 2. 按发运月份匹配当时生效的物料单价
+    df_material['物料单价'] = join_material_prices(df_material, df_material_price)
+    latest_category = df_material_price.drop_duplicates('物料代码', keep='last').set_index('物料代码')['物料类别']
+    df_material['物料类别'] = df_material['物料代码'].map(latest_category).fillna('未分类')
 
-    # 3. 计算物料总成本
+    # 3. 计算物料总成本（没有单价的行保持为空，不当作零成本）
     df_material['物料总成本'] = df_material['物料数量'] * df_material['物料单价']
 
     # 4. 计算销售总额
@@ -152,25 +1054,185 @@ def load_data():
     return df_material, df_sales, df_material_price
 
 
-# 筛选数据函数
-def filter_data(df, regions=None, provinces=None, start_date=None, end_date=None):
-    """按区域、省份和日期筛选数据"""
-    filtered_df = df.copy()
+# 整理单价历史
+def prepare_price_history(df_material_price):
+    """把单价表整理为 (物料代码, 生效月份, 单价（元）) 的价格历史。单价表可以增加“生效月份”列（YYYY-MM或日期），
+    同一物料代码的多行表示不同时期的价格；没有该列时每个价格视为一直有效"""
+    if '生效月份' in df_material_price.columns:
+        effective = pd.to_datetime(df_material_price['生效月份'].astype(str), errors='coerce')
+        # 生效月份为空的行视为最早的价格
+        effective = effective.fillna(pd.Timestamp.min)
+    else:
+        effective = pd.Series(pd.Timestamp.min, index=df_material_price.index)
+
+    # 单价表结构不同时物料类别列名可能为“物料类别1”
+    category_column = next((col for col in ('物料类别', '物料类别1') if col in df_material_price.columns), None)
+    category = df_material_price[category_column] if category_column else pd.Series('未分类', index=df_material_price.index)
+
+    price_history = pd.DataFrame({
+        '物料代码': df_material_price['物料代码'],
+        '物料类别': category.fillna('未分类').astype(str),
+        '生效月份': effective.astype('datetime64[ns]'),
+        '单价（元）': pd.to_numeric(df_material_price['单价（元）'], errors='coerce')
+    }).dropna(subset=['物料代码', '单价（元）'])
+    return price_history.sort_values(['生效月份', '物料代码'], kind='mergesort').reset_index(drop=True)
+
+
+# 匹配物料单价
+def join_material_prices(df_material, price_history):
+    """按 (物料代码, 发运月份) 做as-of连接，返回每行发运月份当时生效的单价（与df_material行对齐）。
+    两边各排序一次后由merge_asof一次完成匹配，复杂度O(n log n)；没有生效单价的行为NaN"""
+    rows = pd.DataFrame({
+        '行号': np.arange(len(df_material)),
+        '物料代码': df_material['物料代码'].to_numpy(),
+        '发运月份': pd.to_datetime(df_material['发运月份']).to_numpy()
+    })
+    # merge_asof要求连接键非空，发运月份无法解析的行不参与匹配
+    dated = rows.dropna(subset=['发运月份']).sort_values('发运月份', kind='mergesort')
+
+    joined = pd.merge_asof(
+        dated,
+        price_history,
+        left_on='发运月份',
+        right_on='生效月份',
+        by='物料代码',
+        direction='backward'
+    )
+
+    prices = np.full(len(df_material), np.nan)
+    prices[joined['行号'].to_numpy()] = joined['单价（元）'].to_numpy(dtype=float)
+    return pd.Series(prices, index=df_material.index)
+
+
+# 未匹配单价的物料代码
+def unmatched_price_codes(df_material):
+    """返回在发运月份没有生效单价的物料代码（排序去重）"""
+    missing = df_material['物料单价'].isna().to_numpy() & df_material['物料代码'].notna().to_numpy()
+    return sorted(pd.unique(df_material['物料代码'].to_numpy()[missing]).tolist(), key=str)
+
+
+# 数据质量检查
+def profile_data_quality(df_material, df_sales):
+    """对物料和销售数据各做一次向量化扫描，返回问题清单：数据表、检查项、问题行数、总行数、示例（最多5个）。
+    只列出问题行数大于0的检查项"""
+    issues = []
+
+    def check(table, name, mask, values, total):
+        count = int(mask.sum())
+        if count:
+            examples = pd.unique(values[mask])[:5]
+            issues.append((table, name, count, total, '、'.join(map(str, examples))))
+
+    def name_conflicts(df):
+        """同一客户代码对应多个经销商名称的行"""
+        pairs = df[['客户代码', '经销商名称']].dropna().drop_duplicates()
+        conflict_codes = pairs['客户代码'][pairs['客户代码'].duplicated()].unique()
+        return df['客户代码'].isin(conflict_codes).to_numpy()
+
+    # 物料数据
+    total = len(df_material)
+    material_codes = df_material['物料代码'].to_numpy()
+    customer_codes = df_material['客户代码'].to_numpy()
+    quantity = pd.to_numeric(df_material['物料数量'], errors='coerce').to_numpy(dtype=float)
+    check('物料数据', '发运月份无法解析', df_material['发运月份'].isna().to_numpy(),
+          np.arange(total) + 2, total)
+    check('物料数据', '物料代码为空', df_material['物料代码'].isna().to_numpy(), np.arange(total) + 2, total)
+    check('物料数据', '物料代码没有生效单价',
+          df_material['物料单价'].isna().to_numpy() & df_material['物料代码'].notna().to_numpy(),
+          material_codes, total)
+    check('物料数据', '物料数量为空或无法解析', np.isnan(quantity), np.arange(total) + 2, total)
+    check('物料数据', '物料数量为负', quantity < 0, material_codes, total)
+    check('物料数据', '客户代码为空', df_material['客户代码'].isna().to_numpy(), np.arange(total) + 2, total)
+    check('物料数据', '客户代码在销售数据中不存在',
+          ~np.isin(customer_codes, df_sales['客户代码'].dropna().unique()) & df_material['客户代码'].notna().to_numpy(),
+          customer_codes, total)
+    check('物料数据', '同一客户代码对应多个经销商名称', name_conflicts(df_material), customer_codes, total)
+    check('物料数据', '所属区域或省份为空',
+          (df_material['所属区域'].isna() | df_material['省份'].isna()).to_numpy(), customer_codes, total)
+
+    # 销售数据
+    total = len(df_sales)
+    sales_customers = df_sales['客户代码'].to_numpy()
+    boxes = pd.to_numeric(df_sales['求和项:数量（箱）'], errors='coerce').to_numpy(dtype=float)
+    unit_price = pd.to_numeric(df_sales['求和项:单价（箱）'], errors='coerce').to_numpy(dtype=float)
+    check('销售数据', '发运月份无法解析', df_sales['发运月份'].isna().to_numpy(), np.arange(total) + 2, total)
+    check('销售数据', '产品代码为空', df_sales['产品代码'].isna().to_numpy(), np.arange(total) + 2, total)
+    check('销售数据', '数量或单价为空', np.isnan(boxes) | np.isnan(unit_price), np.arange(total) + 2, total)
+    check('销售数据', '数量为负', boxes < 0, df_sales['产品代码'].to_numpy(), total)
+    check('销售数据', '单价为负', unit_price < 0, df_sales['产品代码'].to_numpy(), total)
+    check('销售数据', '客户代码为空', df_sales['客户代码'].isna().to_numpy(), np.arange(total) + 2, total)
+    check('销售数据', '同一客户代码对应多个经销商名称', name_conflicts(df_sales), sales_customers, total)
+
+    return pd.DataFrame(issues, columns=['数据表', '检查项', '问题行数', '总行数', '示例'])
+
+
+# 计算筛选行号
+def filter_index(df, regions=None, provinces=None, start_date=None, end_date=None):
+    """返回满足区域、省份和日期条件的行号数组，只生成布尔掩码，不复制数据"""
+    mask = np.ones(len(df), dtype=bool)
 
     # 区域筛选
     if regions and len(regions) > 0:
-        filtered_df = filtered_df[filtered_df['所属区域'].isin(regions)]
+        mask &= df['所属区域'].isin(regions).to_numpy()
 
     # 省份筛选
     if provinces and len(provinces) > 0:
-        filtered_df = filtered_df[filtered_df['省份'].isin(provinces)]
+        mask &= df['省份'].isin(provinces).to_numpy()
 
     # 日期筛选
     if start_date and end_date:
-        filtered_df = filtered_df[(filtered_df['发运月份'] >= pd.Timestamp(start_date)) &
-                                  (filtered_df['发运月份'] <= pd.Timestamp(end_date))]
+        months = df['发运月份']
+        mask &= ((months >= pd.Timestamp(start_date)) & (months <= pd.Timestamp(end_date))).to_numpy()
+
+    return np.flatnonzero(mask)
+
+
+# 筛选数据函数
+def filter_data(df, regions=None, provinces=None, start_date=None, end_date=None):
+    """按区域、省份和日期筛选数据；没有行被筛掉时直接返回共享的只读数据，不做复制"""
+    row_index = filter_index(df, regions, provinces, start_date, end_date)
+    if len(row_index) == len(df):
+        return df
+    return df.take(row_index)
+
+
+# 筛选条件键
+def make_filter_key(version, regions=None, provinces=None, start_date=None, end_date=None):
+    """把数据版本和侧边栏筛选条件规范化为可哈希的键：区域、省份排序去重，日期统一为字符串"""
+    return (
+        version,
+        tuple(sorted(set(regions or []))),
+        tuple(sorted(set(provinces or []))),
+        str(start_date) if start_date else None,
+        str(end_date) if end_date else None
+    )
+
+
+# 默认视图的筛选条件
+def default_filters(registry):
+    """返回侧边栏默认状态（全部区域、全部省份、最新分区的日期范围）对应的筛选条件"""
+    latest = max(registry['partitions'], key=lambda partition: partition['end'])
+    return [], [], latest['start'], latest['end']
 
-    return filtered_df
+
+# 获取分析结果
+def analysis_result(filter_key, name, compute):
+    """依次查找当前快照的预热结果、进程内LRU缓存和磁盘结果缓存，都未命中时调用compute()计算。
+    返回浅拷贝，调用方新增列不会影响共享结果"""
+    if filter_key is None:
+        return compute()
+
+    result = get_data_refresher().snapshot().results.get((filter_key, name))
+    if result is None:
+        result_memo = get_result_memo()
+        result = result_memo.get(filter_key, name)
+        if result is None:
+            result = cached_compute(filter_key, name, compute)
+            result_memo.put(filter_key, name, result)
+
+    if isinstance(result, tuple):
+        return tuple(v.copy(deep=False) if isinstance(v, pd.DataFrame) else v for v in result)
+    return result.copy(deep=False)
 
 
 # 计算费比
@@ -181,10 +1243,266 @@ def calculate_fee_ratio(cost, sales):
     return np.nan  # 返回NaN而不是0，更符合数学逻辑
 
 
+# 解析计算引擎
+def resolve_engine(engine=None):
+    """返回实际使用的计算引擎，未安装polars时回退到pandas"""
+    engine = (engine or ANALYSIS_ENGINE).lower()
+    if engine == "polars" and POLARS_AVAILABLE:
+        return "polars"
+    return "pandas"
+
+
+# Polars惰性计算引擎
+def _lazy(df, columns):
+    """将pandas数据的指定列转换为Polars LazyFrame（只转换需要的列）"""
+    return pl.from_pandas(df[columns]).lazy()
+
+
+def _fee_ratio_expr(cost_col='物料总成本', sales_col='销售总额'):
+    """费比的Polars表达式，与calculate_fee_ratio逻辑一致"""
+    return (
+        pl.when(pl.col(sales_col) > 0)
+        .then(pl.col(cost_col) / pl.col(sales_col) * 100)
+        .otherwise(None)
+        .alias('费比')
+    )
+
+
+def _group_sum(lf, keys, values):
+    """按维度分组求和，与pandas一样丢弃维度为空的行"""
+    return (
+        lf.drop_nulls(subset=keys)
+        .group_by(keys)
+        .agg([pl.col(v).sum() for v in values])
+    )
+
+
+def _region_metrics_polars(filtered_material, filtered_sales):
+    region_material = _group_sum(_lazy(filtered_material, ['所属区域', '物料总成本']), ['所属区域'], ['物料总成本'])
+    region_sales = _group_sum(_lazy(filtered_sales, ['所属区域', '销售总额']), ['所属区域'], ['销售总额'])
+
+    region_metrics = (
+        region_material.join(region_sales, on='所属区域', how='full', coalesce=True)
+        .with_columns(_fee_ratio_expr())
+        .sort('所属区域')
+    )
+    sales_sorted = region_sales.sort(['销售总额', '所属区域'], descending=[True, False])
+
+    sales_df, metrics_df = pl.collect_all([sales_sorted, region_metrics])
+    return sales_df.to_pandas(), metrics_df.to_pandas()
+
+
+def _applicant_data_polars(filtered_material, filtered_sales):
+    applicant_material = _group_sum(
+        _lazy(filtered_material, ['申请人', '物料总成本', '物料数量']), ['申请人'], ['物料总成本', '物料数量']
+    )
+
+    if '申请人' in filtered_sales.columns:
+        sales_lf = _lazy(filtered_sales, ['申请人', '销售总额'])
+    else:
+        applicant_customer_map = _lazy(filtered_material, ['申请人', '客户代码']).unique()
+        sales_lf = _lazy(filtered_sales, ['客户代码', '销售总额']).join(
+            applicant_customer_map, on='客户代码', how='inner'
+        )
+    applicant_sales = _group_sum(sales_lf, ['申请人'], ['销售总额'])
+
+    applicant_data = (
+        applicant_material.join(applicant_sales, on='申请人', how='full', coalesce=True)
+        .with_columns(pl.col(['物料总成本', '物料数量', '销售总额']).fill_null(0))
+        .with_columns(
+            pl.when(pl.col('物料数量') > 0)
+            .then(pl.col('销售总额') / pl.col('物料数量'))
+            .otherwise(0.0)
+            .alias('物料效率')
+        )
+        .with_columns(_fee_ratio_expr())
+        .sort('申请人')
+    )
+    return applicant_data.collect().to_pandas()
+
+
+def _monthly_data_polars(filtered_material, filtered_sales):
+    def monthly(lf, values):
+        # 与pd.Grouper(freq='M')一致：以月末为标签，并补齐中间缺失的月份
+        monthly_lf = _group_sum(
+            lf.with_columns(pl.col('发运月份').dt.truncate('1mo')), ['发运月份'], values
+        )
+        bounds = monthly_lf.select(
+            pl.col('发运月份').min().alias('start'), pl.col('发运月份').max().alias('end')
+        )
+        month_range = bounds.select(
+            pl.datetime_ranges(pl.col('start'), pl.col('end'), interval='1mo').alias('发运月份')
+        ).explode('发运月份').drop_nulls()
+        return (
+            month_range.join(monthly_lf, on='发运月份', how='left')
+            .with_columns(pl.col(values).fill_null(0))
+            .with_columns(pl.col('发运月份').dt.month_end())
+        )
+
+    monthly_material = monthly(_lazy(filtered_material, ['发运月份', '物料总成本', '物料数量']), ['物料总成本', '物料数量'])
+    monthly_sales = monthly(_lazy(filtered_sales, ['发运月份', '销售总额']), ['销售总额'])
+
+    monthly_data = (
+        monthly_material.join(monthly_sales, on='发运月份', how='full', coalesce=True)
+        .sort('发运月份')
+        .with_columns(_fee_ratio_expr())
+        .with_columns(pl.col('发运月份').dt.strftime('%Y-%m').alias('月份'))
+    )
+    return monthly_data.collect().to_pandas()
+
+
+def _customer_value_polars(filtered_material, filtered_sales):
+    keys = ['客户代码', '经销商名称']
+    customer_material = _group_sum(
+        _lazy(filtered_material, keys + ['物料总成本', '物料数量']), keys, ['物料总成本', '物料数量']
+    )
+    customer_sales = _group_sum(_lazy(filtered_sales, keys + ['销售总额']), keys, ['销售总额'])
+
+    customer_value = (
+        customer_material.join(customer_sales, on=keys, how='full', coalesce=True)
+        .with_columns(pl.col(['物料总成本', '物料数量', '销售总额']).fill_null(0))
+        .with_columns(
+            _fee_ratio_expr(),
+            pl.when(pl.col('物料数量') > 0)
+            .then(pl.col('销售总额') / pl.col('物料数量'))
+            .otherwise(0.0)
+            .alias('物料效率'),
+            (pl.col('销售总额') - pl.col('物料总成本')).alias('客户价值'),
+            pl.when(pl.col('物料总成本') > 0)
+            .then((pl.col('销售总额') - pl.col('物料总成本')) / pl.col('物料总成本'))
+            .otherwise(None)
+            .alias('ROI'),
+        )
+        .filter(
+            pl.all_horizontal(
+                pl.col(c).is_not_null() & pl.col(c).is_finite() for c in ['ROI', '费比', '物料效率', '客户价值']
+            )
+        )
+        .sort(keys)
+    )
+    return customer_value.collect().to_pandas()
+
+
+def _material_roi_polars(filtered_material, filtered_sales):
+    keys = ['物料代码', '物料名称']
+    material_lf = _lazy(filtered_material, ['发运月份', '客户代码'] + keys + ['物料数量', '物料总成本'])
+    material_metrics = _group_sum(material_lf, keys, ['物料数量', '物料总成本'])
+
+    # 先按(发运月份, 客户代码)汇总销售额再关联，避免物料行与销售行的笛卡尔展开
+    monthly_customer_sales = (
+        _lazy(filtered_sales, ['发运月份', '客户代码', '销售总额'])
+        .group_by(['发运月份', '客户代码'])
+        .agg(pl.col('销售总额').sum())
+    )
+    material_sales = _group_sum(
+        material_lf.join(monthly_customer_sales, on=['发运月份', '客户代码'], how='inner'), keys, ['销售总额']
+    )
+
+    material_roi = (
+        material_metrics.join(material_sales, on=keys, how='left')
+        .with_columns(pl.col('销售总额').fill_null(0))
+        .with_columns(
+            pl.when(pl.col('物料总成本') > 0)
+            .then((pl.col('销售总额') - pl.col('物料总成本')) / pl.col('物料总成本'))
+            .otherwise(None)
+            .alias('ROI')
+        )
+        .sort(keys)
+    )
+    return material_roi.collect().to_pandas()
+
+
+def _material_product_polars(filtered_material, filtered_sales, lag_effect=False):
+    material_cols = ['发运月份', '客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']
+    sales_cols = ['发运月份', '客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']
+
+    material_lf = _lazy(filtered_material, material_cols)
+    if lag_effect:
+        material_lf = material_lf.with_columns(pl.col('发运月份').dt.offset_by('1mo'))
+    sales_lf = _lazy(filtered_sales, sales_cols)
+
+    material_product = material_lf.join(
+        sales_lf, on=['发运月份', '客户代码', '经销商名称'], how='inner'
+    ).collect()
+
+    loose_match = material_product.is_empty()
+    if loose_match:
+        # 只按客户代码和经销商名称匹配，不考虑发运月份
+        material_product = material_lf.drop('发运月份').join(
+            sales_lf.drop('发运月份'), on=['客户代码', '经销商名称'], how='inner'
+        ).collect()
+
+    return material_product.to_pandas(), loose_match
+
+
+def _material_product_agg_polars(material_product):
+    keys = ['物料名称', '产品名称']
+    material_product_agg = (
+        _group_sum(_lazy(material_product, keys + ['物料数量', '物料总成本', '销售总额']),
+                   keys, ['物料数量', '物料总成本', '销售总额'])
+        .with_columns(
+            pl.when(pl.col('物料总成本') > 0)
+            .then(pl.col('销售总额') / pl.col('物料总成本'))
+            .otherwise(None)
+            .alias('投入产出比')
+        )
+        .sort(keys)
+    )
+    return material_product_agg.collect().to_pandas()
+
+
+# 校验两种计算引擎结果一致
+def check_engine_parity(df_material, df_sales, regions=None, provinces=None, start_date=None, end_date=None):
+    """在给定筛选条件下分别用pandas和polars计算各项分析，结果不一致时抛出AssertionError"""
+    if not POLARS_AVAILABLE:
+        raise RuntimeError("未安装polars，无法校验计算引擎一致性")
+
+    filtered_material = filter_data(df_material, regions, provinces, start_date, end_date)
+    filtered_sales = filter_data(df_sales, regions, provinces, start_date, end_date)
+
+    def compare(name, left, right):
+        sort_cols = [c for c in left.columns if left[c].dtype == object or c == '发运月份']
+        left = left.sort_values(sort_cols).reset_index(drop=True)
+        right = right[left.columns].sort_values(sort_cols).reset_index(drop=True)
+        try:
+            pd.testing.assert_frame_equal(left, right, check_dtype=False, check_exact=False, rtol=1e-9)
+        except AssertionError as e:
+            raise AssertionError(f"{name} 在pandas与polars引擎下结果不一致: {e}")
+
+    for name, compute in [
+        ('区域分析', lambda engine: compute_region_metrics(filtered_material, filtered_sales, engine)[1]),
+        ('申请人分析', lambda engine: compute_applicant_data(filtered_material, filtered_sales, engine)),
+        ('时间趋势', lambda engine: compute_monthly_data(filtered_material, filtered_sales, engine)),
+        ('客户价值', lambda engine: compute_customer_value(filtered_material, filtered_sales, engine)),
+        ('物料效益', lambda engine: compute_material_roi(filtered_material, filtered_sales, engine)),
+    ]:
+        compare(name, compute('pandas'), compute('polars'))
+
+    for lag_effect in (False, True):
+        pandas_product, pandas_loose = compute_material_product(filtered_material, filtered_sales, lag_effect, 'pandas')
+        polars_product, polars_loose = compute_material_product(filtered_material, filtered_sales, lag_effect, 'polars')
+        assert pandas_loose == polars_loose, "物料-产品关联的匹配方式在两种引擎下不一致"
+        compare('物料-产品关联', pandas_product, polars_product)
+        compare('物料-产品汇总', aggregate_material_product(pandas_product, 'pandas'),
+                aggregate_material_product(polars_product, 'polars'))
+
+
 # 创建KPI卡片
-def display_kpi_cards(total_material_cost, total_sales, overall_cost_sales_ratio, avg_material_effectiveness):
-    """显示KPI卡片"""
+def display_kpi_cards(total_material_cost, total_sales, overall_cost_sales_ratio, avg_material_effectiveness,
+                      previous=None):
+    """显示KPI卡片；previous为对比期的同样四个指标时，在每张卡片下方显示对比期数值和变化"""
     cols = st.columns(4)
+    comparison = ["", "", "", ""]
+    if previous is not None:
+        current = (total_material_cost, total_sales, overall_cost_sales_ratio, avg_material_effectiveness)
+        for i, (value, base) in enumerate(zip(current, previous)):
+            if i == 2:
+                # 费比的变化用百分点表示
+                text = f"对比期 {base:.2f}%（{value - base:+.2f}个百分点）"
+            else:
+                change = f"{(value / base - 1) * 100:+.2f}%" if base else "-"
+                text = f"对比期 ￥{base:,.2f}（{change}）"
+            comparison[i] = f'<p class="card-text">{text}</p>'
 
     # 总物料成本 - 修改为保留两位小数
     with cols[0]:
@@ -193,6 +1511,7 @@ def display_kpi_cards(total_material_cost, total_sales, overall_cost_sales_ratio
             <p class="card-header">总物料成本</p>
             <p class="card-value">￥{total_material_cost:,.2f}</p>
             <p class="card-text">总投入物料资金</p>
+            {comparison[0]}
         </div>
         """, unsafe_allow_html=True)
 
@@ -203,6 +1522,7 @@ def display_kpi_cards(total_material_cost, total_sales, overall_cost_sales_ratio
             <p class="card-header">总销售额</p>
             <p class="card-value">￥{total_sales:,.2f}</p>
             <p class="card-text">总体销售收入</p>
+            {comparison[1]}
         </div>
         """, unsafe_allow_html=True)
 
@@ -214,6 +1534,7 @@ def display_kpi_cards(total_material_cost, total_sales, overall_cost_sales_ratio
             <p class="card-header">总体费比</p>
             <p class="card-value" style="color: {fee_color};">{overall_cost_sales_ratio:.2f}%</p>
             <p class="card-text">物料成本占销售额比例</p>
+            {comparison[2]}
         </div>
         """, unsafe_allow_html=True)
 
@@ -224,23 +1545,51 @@ def display_kpi_cards(total_material_cost, total_sales, overall_cost_sales_ratio
             <p class="card-header">平均物料效益</p>
             <p class="card-value">￥{avg_material_effectiveness:,.2f}</p>
             <p class="card-text">每单位物料平均产生销售额</p>
+            {comparison[3]}
         </div>
         """, unsafe_allow_html=True)
 
 
+# 计算区域销售与费比
+def compute_region_metrics(filtered_material, filtered_sales, engine=None):
+    """返回区域销售排名和区域费比两张汇总表"""
+    if resolve_engine(engine) == "polars":
+        return _region_metrics_polars(filtered_material, filtered_sales)
+
+    region_sales = filtered_sales.groupby('所属区域').agg({
+        '销售总额': 'sum'
+    }).reset_index().sort_values('销售总额', ascending=False)
+
+    region_material = filtered_material.groupby('所属区域').agg({
+        '物料总成本': 'sum'
+    }).reset_index()
+
+    region_sales_data = filtered_sales.groupby('所属区域').agg({
+        '销售总额': 'sum'
+    }).reset_index()
+
+    region_metrics = pd.merge(region_material, region_sales_data, on='所属区域', how='outer')
+    region_metrics['费比'] = region_metrics.apply(
+        lambda row: calculate_fee_ratio(row['物料总成本'], row['销售总额']), axis=1
+    )
+
+    return region_sales, region_metrics
+
+
 # 区域销售分析
-def region_analysis(filtered_material, filtered_sales):
+def region_analysis(filtered_material, filtered_sales, filter_key=None):
     """区域销售与费比分析"""
     st.markdown("## 区域分析")
 
+    region_sales, region_metrics = analysis_result(
+        filter_key, 'region', lambda: compute_region_metrics(filtered_material, filtered_sales)
+    )
+    export_buttons("区域指标", region_metrics, filter_key)
+
     cols = st.columns(2)
 
     with cols[0]:
         # 区域销售图表
-        region_sales = filtered_sales.groupby('所属区域').agg({
-            '销售总额': 'sum'
-        }).reset_index().sort_values('销售总额', ascending=False)
-
         if not region_sales.empty:
             fig = px.bar(
                 region_sales,
@@ -248,7 +1597,8 @@ def region_analysis(filtered_material, filtered_sales):
                 y='销售总额',
                 title="各区域销售总额",
                 color='所属区域',
-                text='销售总额'
+                text='销售总额',
+                custom_data=['所属区域']
             )
             fig.update_traces(
                 texttemplate='￥%{text:,.2f}',  # 修改为保留两位小数
@@ -259,12 +1609,14 @@ def region_analysis(filtered_material, filtered_sales):
                 yaxis_title="销售总额 (元)",
                 yaxis=dict(tickprefix="￥", tickformat=",.2f")
             )
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True, key='chart_region_sales', selection_mode='points',
+                            on_select=lambda: select_cross_filter('chart_region_sales'))
 
             # 添加图表解读
             st.markdown("""
             **图表解读：**
             - 此图表展示了各个销售区域的总销售额排名。
+            - 点击柱形可将其他分析筛选为该区域，按住Shift可多选。
             - 柱形越高表示该区域销售业绩越好。
             - 可以清晰识别出表现最突出的区域和需要加强的区域。
             - 业务团队可根据此图调整区域资源分配，重点支持高潜力区域。
@@ -274,19 +1626,6 @@ def region_analysis(filtered_material, filtered_sales):
 
     with cols[1]:
         # 区域物料费比分析
-        region_material = filtered_material.groupby('所属区域').agg({
-            '物料总成本': 'sum'
-        }).reset_index()
-
-        region_sales_data = filtered_sales.groupby('所属区域').agg({
-            '销售总额': 'sum'
-        }).reset_index()
-
-        region_metrics = pd.merge(region_material, region_sales_data, on='所属区域', how='outer')
-        region_metrics['费比'] = region_metrics.apply(
-            lambda row: calculate_fee_ratio(row['物料总成本'], row['销售总额']), axis=1
-        )
-
         if not region_metrics.empty:
             fig = px.bar(
                 region_metrics.sort_values('费比'),
@@ -320,15 +1659,85 @@ def region_analysis(filtered_material, filtered_sales):
             st.warning("没有足够的数据来生成区域费比图表")
 
 
-# 申请人使用物料效率分析
-def applicant_material_efficiency_analysis(filtered_material, filtered_sales):
-    """申请人使用物料效率分析"""
-    st.markdown("## 申请人使用物料效率分析")
-
-    # 确保数据中有申请人字段
-    if '申请人' not in filtered_material.columns:
-        st.warning("数据中缺少'申请人'字段，无法进行申请人物料效率分析")
-        return
+# 计算申请人物料效率
+def bootstrap_ratio_ci(entities, numerator, denominator, confidence=0.95):
+    """对每个实体的观测单元有放回重抽样，估计 Σ分子/Σ分母 的百分位置信区间。
+    观测按实体排序后，每批重抽样生成一个 [重抽样次数, 观测数] 的索引矩阵（每列只在该列所属实体的观测中抽取），
+    由于同一实体的观测连续存放，np.add.reduceat一次即可求出所有实体、所有重抽样的分子分母之和，不逐个实体循环。
+    entities可以是Series或MultiIndex；返回以实体为索引的DataFrame：观测数、估计值、下限、上限，
+    观测数少于2的实体区间为NaN"""
+    codes, uniques = pd.factorize(entities)
+    keep = codes >= 0
+    order = np.argsort(codes[keep], kind='stable')
+    codes = codes[keep][order]
+    numerator = np.nan_to_num(np.asarray(numerator, dtype=float)[keep][order])
+    denominator = np.nan_to_num(np.asarray(denominator, dtype=float)[keep][order])
+    n_entities, n_obs = len(uniques), len(codes)
+    if n_obs == 0:
+        return pd.DataFrame(columns=['观测数', '估计值', '下限', '上限'], index=uniques)
+
+    counts = np.bincount(codes, minlength=n_entities)
+    starts = np.cumsum(counts) - counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        estimate = np.add.reduceat(numerator, starts) / np.add.reduceat(denominator, starts)
+
+    rng = np.random.default_rng(BOOTSTRAP_SEED)
+    ratios = np.empty((BOOTSTRAP_SAMPLES, n_entities))
+    batch = max(1, BOOTSTRAP_BATCH_CELLS // n_obs)
+    obs_start, obs_count = starts[codes], counts[codes]
+    for first in range(0, BOOTSTRAP_SAMPLES, batch):
+        size = min(batch, BOOTSTRAP_SAMPLES - first)
+        draws = obs_start + (rng.random((size, n_obs)) * obs_count).astype(np.int64)
+        num_sum = np.add.reduceat(numerator[draws], starts, axis=1)
+        den_sum = np.add.reduceat(denominator[draws], starts, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios[first:first + size] = np.where(den_sum != 0, num_sum / den_sum, np.nan)
+
+    # 只有部分重抽样分母为0的实体才需要较慢的nanpercentile
+    tail = (1 - confidence) / 2 * 100
+    has_nan = np.isnan(ratios).any(axis=0)
+    bounds = np.empty((2, n_entities))
+    bounds[:, ~has_nan] = np.percentile(ratios[:, ~has_nan], [tail, 100 - tail], axis=0)
+    if has_nan.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            bounds[:, has_nan] = np.nanpercentile(ratios[:, has_nan], [tail, 100 - tail], axis=0)
+
+    reliable = counts >= 2
+    return pd.DataFrame({
+        '观测数': counts,
+        '估计值': estimate,
+        '下限': np.where(reliable, bounds[0], np.nan),
+        '上限': np.where(reliable, bounds[1], np.nan)
+    }, index=uniques)
+
+
+# 计算申请人指标置信区间
+def compute_applicant_ci(filtered_material, filtered_sales):
+    """以 (申请人, 客户, 月份) 为观测单元，自助法估计每个申请人物料效率和费比的95%置信区间"""
+    keys = ['申请人', '客户代码', '发运月份']
+    units = pd.merge(
+        filtered_material.groupby(keys)[['物料总成本', '物料数量']].sum().reset_index(),
+        filtered_sales.groupby(keys)['销售总额'].sum().reset_index(),
+        on=keys, how='outer'
+    ).fillna({'物料总成本': 0, '物料数量': 0, '销售总额': 0})
+
+    efficiency = bootstrap_ratio_ci(units['申请人'], units['销售总额'], units['物料数量'])
+    fee_ratio = bootstrap_ratio_ci(units['申请人'], units['物料总成本'] * 100, units['销售总额'])
+    return pd.DataFrame({
+        '申请人': efficiency.index,
+        '观测数': efficiency['观测数'].to_numpy(),
+        '物料效率下限': efficiency['下限'].to_numpy(),
+        '物料效率上限': efficiency['上限'].to_numpy(),
+        '费比下限': fee_ratio['下限'].reindex(efficiency.index).to_numpy(),
+        '费比上限': fee_ratio['上限'].reindex(efficiency.index).to_numpy()
+    })
+
+
+def compute_applicant_data(filtered_material, filtered_sales, engine=None):
+    """按申请人汇总物料成本、物料数量、销售额，并计算物料效率和费比"""
+    if resolve_engine(engine) == "polars":
+        return _applicant_data_polars(filtered_material, filtered_sales)
 
     # 按申请人聚合数据
     applicant_material = filtered_material.groupby('申请人').agg({
@@ -367,13 +1776,50 @@ def applicant_material_efficiency_analysis(filtered_material, filtered_sales):
         lambda row: calculate_fee_ratio(row['物料总成本'], row['销售总额']), axis=1
     )
 
+    return applicant_data
+
+
+# 申请人使用物料效率分析
+def applicant_material_efficiency_analysis(filtered_material, filtered_sales, filter_key=None, distinct=None):
+    """申请人使用物料效率分析。distinct为DistinctCounter时，物料种类数和客户数量从去重计数存储合并得到"""
+    st.markdown("## 申请人使用物料效率分析")
+
+    # 确保数据中有申请人字段
+    if '申请人' not in filtered_material.columns:
+        st.warning("数据中缺少'申请人'字段，无法进行申请人物料效率分析")
+        return
+
+    applicant_data = analysis_result(
+        filter_key, 'applicant', lambda: compute_applicant_data(filtered_material, filtered_sales)
+    )
+    applicant_ci = analysis_result(
+        filter_key, 'applicant_ci', lambda: compute_applicant_ci(filtered_material, filtered_sales)
+    )
+    export_buttons("申请人物料效率", applicant_data, filter_key)
+    with st.expander(f"浏览全部 {len(applicant_data):,} 位申请人"):
+        paginated_table("申请人物料效率", applicant_data, filter_key, search_columns=('申请人',),
+                        default_sort='销售总额', formats={
+                            '物料总成本': '￥{:,.2f}',
+                            '销售总额': '￥{:,.2f}',
+                            '物料效率': '{:,.2f}',
+                            '费比': '{:.2f}%'
+                        })
+
     # 创建物料效率图表
     cols = st.columns(2)
 
     with cols[0]:
         if not applicant_data.empty and len(applicant_data) > 0:
-            # 按物料效率排序，选取前10名
-            top_applicants = applicant_data.nlargest(10, '物料效率')
+            rank_by_lower = st.checkbox("按物料效率置信下限排序", value=False,
+                                        help="按95%置信区间下限排名，样本少、波动大的申请人不会因偶然的高值排在前面")
+
+            # 按物料效率（或其置信下限）排序，选取前10名
+            ranked = pd.merge(applicant_data, applicant_ci, on='申请人', how='left')
+            top_applicants = ranked.nlargest(10, '物料效率下限' if rank_by_lower else '物料效率')
+            top_applicants = top_applicants.assign(
+                误差上=top_applicants['物料效率上限'] - top_applicants['物料效率'],
+                误差下=top_applicants['物料效率'] - top_applicants['物料效率下限']
+            )
 
             fig = px.bar(
                 top_applicants,
@@ -382,7 +1828,10 @@ def applicant_material_efficiency_analysis(filtered_material, filtered_sales):
                 title="申请人物料效率TOP10",
                 color='费比',
                 color_continuous_scale='RdYlGn_r',
-                text='物料效率'
+                text='物料效率',
+                error_y='误差上',
+                error_y_minus='误差下',
+                hover_data=['观测数', '费比下限', '费比上限']
             )
 
             fig.update_traces(
@@ -406,6 +1855,7 @@ def applicant_material_efficiency_analysis(filtered_material, filtered_sales):
             - 物料效率表示每单位物料产生的销售额，数值越高表示物料使用效率越高。
             - 颜色深浅表示费比水平，颜色越浅表示费比越低，物料利用效率越高。
             - TOP10申请人在物料利用方面表现最佳，值得学习其物料使用经验。
+            - 误差线为自助法估计的95%置信区间，区间越宽表示该申请人的数据越少或波动越大。
             - 对于高效率但费比较高的申请人，可以探索如何优化其物料组合。
             - 建议组织高效率申请人分享经验，提升团队整体物料使用水平。
             """)
@@ -458,14 +1908,18 @@ def applicant_material_efficiency_analysis(filtered_material, filtered_sales):
     if not applicant_data.empty and len(applicant_data) >= 5:
         st.markdown("### 申请人物料使用习惯分析")
 
-        # 获取每个申请人使用的物料类型
-        applicant_material_types = filtered_material.groupby('申请人')['物料名称'].apply(
-            lambda x: len(set(x))
-        ).reset_index()
-        applicant_material_types.columns = ['申请人', '物料种类数']
+        if distinct is not None:
+            applicant_material_types = distinct.count('申请人', '物料名称')
+            applicant_customer_count = distinct.count('申请人', '客户代码')
+        else:
+            # 获取每个申请人使用的物料类型
+            applicant_material_types = filtered_material.groupby('申请人')['物料名称'].apply(
+                lambda x: len(set(x))
+            ).reset_index()
 
-        # 获取每个申请人的客户数量
-        applicant_customer_count = filtered_material.groupby('申请人')['客户代码'].nunique().reset_index()
+            # 获取每个申请人的客户数量
+            applicant_customer_count = filtered_material.groupby('申请人')['客户代码'].nunique().reset_index()
+        applicant_material_types.columns = ['申请人', '物料种类数']
         applicant_customer_count.columns = ['申请人', '客户数量']
 
         # 合并数据
@@ -709,10 +2163,11 @@ def applicant_material_efficiency_analysis(filtered_material, filtered_sales):
                     """)
             else:
                 st.warning(f"未找到 {selected_applicant} 的物料使用数据")
-# 时间趋势分析
-def time_analysis(filtered_material, filtered_sales):
-    """时间趋势分析"""
-    st.markdown("## 时间趋势分析")
+# 计算月度趋势
+def compute_monthly_data(filtered_material, filtered_sales, engine=None):
+    """按月汇总物料成本、物料数量和销售额，并计算月度费比"""
+    if resolve_engine(engine) == "polars":
+        return _monthly_data_polars(filtered_material, filtered_sales)
 
     # 按月份聚合数据
     monthly_material = filtered_material.groupby(pd.Grouper(key='发运月份', freq='M')).agg({
@@ -735,8 +2190,23 @@ def time_analysis(filtered_material, filtered_sales):
     # 添加格式化月份字段
     monthly_data['月份'] = monthly_data['发运月份'].dt.strftime('%Y-%m')
 
+    return monthly_data
+
+
+# 时间趋势分析
+def time_analysis(filtered_material, filtered_sales, filter_key=None):
+    """时间趋势分析"""
+    st.markdown("## 时间趋势分析")
+
+    monthly_data = analysis_result(
+        filter_key, 'monthly', lambda: compute_monthly_data(filtered_material, filtered_sales)
+    )
+    export_buttons("月度趋势", monthly_data, filter_key)
+
     if len(monthly_data) >= 3:
         # 创建销售额和物料成本趋势图
+        from plotly.subplots import make_subplots
+
         fig = make_subplots(specs=[[{"secondary_y": True}]])
 
         # 添加销售额线
@@ -828,10 +2298,505 @@ def time_analysis(filtered_material, filtered_sales):
         st.warning("没有足够的数据来生成时间趋势图表")
 
 
-# 客户价值分析
-def customer_analysis(filtered_material, filtered_sales):
-    """客户价值分析"""
-    st.markdown("## 客户价值分析")
+# 按月汇总（不补零）
+def compute_monthly_totals(df_material, df_sales):
+    """按月汇总物料成本、物料数量和销售额，只包含有记录的月份（以月末日期为键）。
+    与compute_monthly_data不同，某月只有一方有记录时另一方为NaN而不是0，不会把数据源尚未覆盖的月份当作零销售"""
+    material = df_material.groupby(df_material['发运月份'] + pd.offsets.MonthEnd(0))[['物料总成本', '物料数量']].sum()
+    sales = df_sales.groupby(df_sales['发运月份'] + pd.offsets.MonthEnd(0))[['销售总额']].sum()
+    return material.join(sales, how='outer').rename_axis('发运月份').reset_index()
+
+
+# 计算跨年同比
+def compute_year_over_year(snapshot, regions, provinces, start_date, end_date, customers=None):
+    """把所选日期范围内的每个月与上一年同月比较。每个分区的月度汇总（只按区域、省份和联动筛选的客户筛选）单独缓存，
+    同一分区在不同日期范围、不同对比年份之间复用，不需要把多年明细拼接后重新分组"""
+    range_start = pd.Timestamp(start_date) - pd.DateOffset(years=1)
+    needed = select_partitions(snapshot.registry, range_start.date(), end_date)
+
+    monthly_parts = []
+    for name in needed:
+        df_material, df_sales, _ = snapshot.partition(name)
+        if df_material is None:
+            continue
+        partition_key = make_filter_key(snapshot.dataset_version([name]), regions, provinces)
+        cross_filters = {'客户代码': customers} if customers else {}
+        monthly_parts.append(analysis_result(
+            cross_filter_key(partition_key, cross_filters), 'monthly_totals',
+            lambda df_material=df_material, df_sales=df_sales, partition_key=partition_key: compute_monthly_totals(
+                apply_cross_filters(partition_key, '物料', filter_data(df_material, regions, provinces), cross_filters),
+                apply_cross_filters(partition_key, '销售', filter_data(df_sales, regions, provinces), cross_filters)
+            )
+        ))
+    if not monthly_parts:
+        return pd.DataFrame()
+
+    # 分区之间可能有重叠月份，先按月合并；各分区在该月都没有记录的一方保持NaN
+    monthly = pd.concat(monthly_parts, ignore_index=True).groupby('发运月份', as_index=False)[
+        ['物料总成本', '物料数量', '销售总额']
+    ].sum(min_count=1)
+
+    current = monthly[
+        (monthly['发运月份'] >= pd.Timestamp(start_date)) &
+        (monthly['发运月份'] <= pd.Timestamp(end_date) + pd.offsets.MonthEnd(0))
+    ].copy()
+    last_year = monthly[['发运月份', '物料总成本', '销售总额']].copy()
+    last_year['发运月份'] = last_year['发运月份'] + pd.DateOffset(years=1) + pd.offsets.MonthEnd(0)
+    yoy = pd.merge(current, last_year, on='发运月份', how='left', suffixes=('', '_去年'))
+
+    yoy['费比'] = yoy.apply(lambda row: calculate_fee_ratio(row['物料总成本'], row['销售总额']), axis=1)
+    yoy['费比_去年'] = yoy.apply(lambda row: calculate_fee_ratio(row['物料总成本_去年'], row['销售总额_去年']), axis=1)
+    yoy['销售额同比'] = np.where(
+        yoy['销售总额_去年'] > 0, (yoy['销售总额'] / yoy['销售总额_去年'] - 1) * 100, np.nan
+    )
+    yoy['物料成本同比'] = np.where(
+        yoy['物料总成本_去年'] > 0, (yoy['物料总成本'] / yoy['物料总成本_去年'] - 1) * 100, np.nan
+    )
+    yoy['月份'] = yoy['发运月份'].dt.strftime('%Y-%m')
+    return yoy.sort_values('发运月份').reset_index(drop=True)
+
+
+# 构建时间序列存储
+def build_time_series_store(df_material, df_sales):
+    """按TIME_SERIES_RESOLUTIONS的每个粒度、TIME_SERIES_DIMENSIONS的每个维度预先汇总物料成本、物料数量和销售额，
+    返回 {粒度: {维度: 汇总表}}。汇总表保留所属区域、省份列，读取时可以直接应用侧边栏的区域、省份筛选；
+    物料维度在销售数据中不存在，只有物料成本和数量"""
+    store = {}
+    for resolution, (freq, _) in TIME_SERIES_RESOLUTIONS.items():
+        material_period = df_material['发运月份'].dt.to_period(freq).dt.start_time
+        sales_period = df_sales['发运月份'].dt.to_period(freq).dt.start_time
+        store[resolution] = {}
+        for dimension, columns in TIME_SERIES_DIMENSIONS.items():
+            keys = list(dict.fromkeys(['所属区域', '省份'] + columns))
+            series = df_material[keys + ['物料总成本', '物料数量']].assign(周期=material_period).groupby(
+                keys + ['周期'], dropna=False, sort=False
+            ).sum().reset_index()
+            if dimension != '物料':
+                sales = df_sales[keys + ['销售总额']].assign(周期=sales_period).groupby(
+                    keys + ['周期'], dropna=False, sort=False
+                ).sum().reset_index()
+                series = pd.merge(series, sales, on=keys + ['周期'], how='outer')
+            store[resolution][dimension] = series
+    return store
+
+
+# 计算滚动指标
+def add_rolling_metrics(series, keys, resolution):
+    """对按 keys + 周期 汇总的序列一次性计算费比、移动平均、环比和同比（所有维度值一起向量化计算）。
+    移动平均、环比、同比都按周期对齐：中间缺少的周期按0计入移动平均，不会让窗口跨越超过ROLLING_WINDOW个周期；
+    维度值首次出现之前的周期不计入，序列开头的窗口只平均已有的周期"""
+    series = series.sort_values(keys + ['周期'], kind='mergesort').reset_index(drop=True)
+    values = [col for col in ('销售总额', '物料总成本') if col in series.columns]
+
+    def shifted(offset):
+        """每行对应的 周期-offset 那一行的数值，没有该周期时为NaN"""
+        previous = series[keys + ['周期'] + values].copy()
+        previous['周期'] = previous['周期'] + offset
+        return pd.merge(series[keys + ['周期']], previous, on=keys + ['周期'], how='left', suffixes=('', '_上期'))
+
+    _, step = TIME_SERIES_RESOLUTIONS[resolution]
+    first_period = series.groupby(keys, sort=False, dropna=False)['周期'].transform('min') if keys \
+        else series['周期'].min()
+    window_totals = {col: np.zeros(len(series)) for col in values}
+    window_periods = np.zeros(len(series))
+    for lag in range(ROLLING_WINDOW):
+        merged = shifted(step * lag)
+        for col in values:
+            window_totals[col] += np.nan_to_num(merged[col].to_numpy(dtype=float))
+        window_periods += (series['周期'] >= first_period + step * lag).to_numpy()
+    for col in values:
+        series[f'{col}移动平均'] = window_totals[col] / window_periods
+
+    for label, offset in (('环比', step), ('同比', pd.DateOffset(years=1))):
+        merged = shifted(offset)
+        for col in values:
+            base = merged[col].to_numpy(dtype=float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                series[f'{col}{label}'] = np.where(base > 0, (series[col].to_numpy(dtype=float) / base - 1) * 100, np.nan)
+
+    if '销售总额' in series.columns:
+        sales = series['销售总额'].to_numpy(dtype=float)
+        cost = series['物料总成本'].to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            series['费比'] = np.where(sales > 0, cost / sales * 100, np.nan)
+    return series
+
+
+# 查询时间序列
+def compute_time_series(snapshot, resolution, dimension, regions, provinces, start_date, end_date, customers=None):
+    """从时间序列存储读取所选粒度、维度的序列，应用区域、省份筛选并计算滚动指标，只保留与日期范围重叠的周期。
+    上一年的分区也会读取，保证范围内第一个周期的环比、同比有基准。
+    指定customers（联动筛选的客户）时从客户维度的汇总表筛选客户后再汇总到所选维度；物料维度的汇总表不含客户，不受影响"""
+    keys = TIME_SERIES_DIMENSIONS[dimension]
+    range_start = pd.Timestamp(start_date) - pd.DateOffset(years=1)
+    by_customer = bool(customers) and dimension != '物料'
+
+    tables = []
+    for name in select_partitions(snapshot.registry, range_start.date(), end_date):
+        store = snapshot.time_series_store(name)
+        if store is not None:
+            tables.append(store[resolution]['客户' if by_customer else dimension])
+    if not tables:
+        return pd.DataFrame()
+
+    table = pd.concat(tables, ignore_index=True)
+    mask = np.ones(len(table), dtype=bool)
+    if regions:
+        mask &= table['所属区域'].isin(regions).to_numpy()
+    if provinces:
+        mask &= table['省份'].isin(provinces).to_numpy()
+    if by_customer:
+        mask &= table['客户代码'].isin(customers).to_numpy()
+    table = table[mask]
+
+    values = [col for col in ('物料总成本', '物料数量', '销售总额') if col in table.columns]
+    series = table.groupby(keys + ['周期'], dropna=False, sort=False)[values].sum(min_count=1).reset_index()
+    series = add_rolling_metrics(series, keys, resolution)
+
+    freq, _ = TIME_SERIES_RESOLUTIONS[resolution]
+    period_end = series['周期'].dt.to_period(freq).dt.end_time
+    series = series[
+        (series['周期'] <= pd.Timestamp(end_date)) & (period_end >= pd.Timestamp(start_date))
+    ].reset_index(drop=True)
+
+    # 累计值只在所选日期范围内累加
+    for col in ('销售总额', '物料总成本'):
+        if col in series.columns:
+            series[f'累计{col}'] = series.groupby(keys, sort=False, dropna=False)[col].cumsum() if keys else series[col].cumsum()
+    series['周期'] = series['周期'].dt.to_period(freq).astype(str)
+    return series
+
+
+# 构建去重计数存储
+def build_distinct_store(df_material, df_sales):
+    """按DISTINCT_CELL_COLUMNS把物料数据划分为单元格，对DISTINCT_COLUMNS的每一列保存：
+    exact - 每个单元格内去重后的 (单元格, 64位哈希)，合并后按哈希去重即得精确计数；
+    sketch - 稀疏HyperLogLog草图 (单元格, 寄存器, 秩)，每个单元格只保存非零寄存器，合并时按寄存器取最大值。
+    值用64位哈希表示，不同分区的存储可以直接合并"""
+    cell_frame = df_material[DISTINCT_CELL_COLUMNS]
+    cell_id = cell_frame.groupby(DISTINCT_CELL_COLUMNS, dropna=False, sort=False, observed=True).ngroup().to_numpy()
+    _, first_row = np.unique(cell_id, return_index=True)
+    store = {'cells': cell_frame.iloc[first_row].reset_index(drop=True)}
+
+    for column in DISTINCT_COLUMNS:
+        valid = df_material[column].notna().to_numpy()
+        hashes = pd.util.hash_array(df_material.loc[valid, column].astype(str).to_numpy(dtype=object))
+        cells = cell_id[valid]
+
+        # 高HLL_PRECISION位决定寄存器，低32位中最高位1的位置决定秩（低32位全为0时秩为33）
+        register = (hashes >> np.uint64(64 - HLL_PRECISION)).astype(np.int32)
+        low_bits = (hashes & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        rank = (33 - np.frexp(low_bits)[1]).astype(np.uint8)
+
+        store[column] = {
+            'exact': pd.DataFrame({'cell': cells, 'hash': hashes}).drop_duplicates().reset_index(drop=True),
+            'sketch': pd.DataFrame({'cell': cells, 'register': register, 'rank': rank})
+            .groupby(['cell', 'register'], sort=False)['rank'].max().reset_index()
+        }
+    return store
+
+
+# 合并去重计数
+def compute_distinct_counts(stores, group_by, column, regions, provinces, start_date, end_date, exact=False):
+    """合并各分区去重计数存储中满足区域、省份和日期筛选的单元格，按group_by分组返回column的去重数。
+    exact为True时合并哈希集合得到精确值，否则合并HyperLogLog草图得到估计值"""
+    cells, parts, offset = [], [], 0
+    for store in stores:
+        part = store[column]['exact' if exact else 'sketch']
+        cells.append(store['cells'])
+        parts.append(part.assign(cell=part['cell'].to_numpy() + offset))
+        offset += len(store['cells'])
+    if not cells:
+        return pd.DataFrame(columns=[group_by, '去重数'])
+    cells = pd.concat(cells, ignore_index=True)
+    part = pd.concat(parts, ignore_index=True)
+
+    # 未被筛选选中的单元格不属于任何分组
+    group_of_cell, groups = pd.factorize(cells[group_by])
+    selected = np.zeros(len(cells), dtype=bool)
+    selected[filter_index(cells, regions, provinces, start_date, end_date)] = True
+    group_of_cell[~selected] = -1
+    group = group_of_cell[part['cell'].to_numpy()]
+    keep = group >= 0
+
+    if exact:
+        pairs = pd.DataFrame({'group': group[keep], 'hash': part['hash'].to_numpy()[keep]}).drop_duplicates()
+        counts = np.bincount(pairs['group'], minlength=len(groups)).astype(float)
+    else:
+        registers = pd.DataFrame({
+            'group': group[keep], 'register': part['register'].to_numpy()[keep], 'rank': part['rank'].to_numpy()[keep]
+        }).groupby(['group', 'register'], sort=False)['rank'].max().reset_index()
+        m = 2 ** HLL_PRECISION
+        nonzero = np.bincount(registers['group'], minlength=len(groups))
+        zeros = m - nonzero
+        # 空寄存器的秩为0，对调和平均的贡献为 2^0 = 1
+        harmonic = np.bincount(registers['group'], weights=np.exp2(-registers['rank'].to_numpy(dtype=float)),
+                               minlength=len(groups)) + zeros
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / harmonic
+        # 基数较小时用线性计数修正
+        with np.errstate(divide='ignore'):
+            counts = np.where((raw <= 2.5 * m) & (zeros > 0), m * np.log(m / np.maximum(zeros, 1)), raw)
+        counts = np.where(nonzero > 0, counts, 0)
+
+    result = pd.DataFrame({group_by: groups, '去重数': np.round(counts).astype(int)})
+    return result[result['去重数'] > 0].reset_index(drop=True)
+
+
+class DistinctCounter:
+    """当前筛选条件下的去重计数：从所选分区的去重计数存储合并，结果按筛选键缓存"""
+
+    def __init__(self, snapshot, partition_names, filter_key, regions, provinces, start_date, end_date, exact=False):
+        self.snapshot = snapshot
+        self.partition_names = partition_names
+        self.filter_key = filter_key
+        self.filters = (regions, provinces, start_date, end_date)
+        self.exact = exact
+
+    def count(self, group_by, column):
+        """返回 [group_by, 去重数]，group_by须为DISTINCT_CELL_COLUMNS中的列"""
+        return analysis_result(
+            self.filter_key, ('distinct', group_by, column, self.exact),
+            lambda: compute_distinct_counts(
+                [store for store in map(self.snapshot.distinct_store, self.partition_names) if store is not None],
+                group_by, column, *self.filters, exact=self.exact
+            )
+        )
+
+
+# 构建透视汇总数据
+def build_pivot_cube(df_material, df_sales):
+    """按PIVOT_DIMENSIONS中的非时间维度加发运月份，把物料数据汇总物料数量、物料总成本，销售数据汇总销售总额，
+    返回 {'物料': 汇总表, '销售': 汇总表}。汇总表保留所属区域、省份和发运月份，可以直接应用侧边栏筛选；
+    透视查询只在这两张汇总表上分组，不再扫描明细或关联物料和销售明细"""
+    cube = {}
+    for source, frame, values in (('物料', df_material, ['物料数量', '物料总成本']), ('销售', df_sales, ['销售总额'])):
+        keys = [dimension for dimension, where in PIVOT_DIMENSIONS.items()
+                if where in ('共有', source) and dimension not in PIVOT_TIME_DIMENSIONS]
+        cube[source] = frame[keys + ['发运月份'] + values].groupby(
+            keys + ['发运月份'], dropna=False, sort=False, observed=True
+        ).sum().reset_index()
+    return cube
+
+
+# 计算透视表
+def compute_pivot(snapshot, partition_names, rows, columns, measure, pivot_filters,
+                  regions, provinces, start_date, end_date):
+    """在所选分区的透视汇总数据上应用侧边栏筛选和透视筛选，按行、列维度分组后计算指标并展开为透视表。
+    只有物料或只有销售数据中存在的维度不能与另一方的指标组合，此时返回 (空表, 原因)"""
+    dimensions = list(rows) + list(columns)
+    sources = ['物料', '销售'] if PIVOT_MEASURES[measure] == '共有' else [PIVOT_MEASURES[measure]]
+    unavailable = [d for d in dimensions + list(pivot_filters)
+                   if PIVOT_DIMENSIONS[d] != '共有' and sources != [PIVOT_DIMENSIONS[d]]]
+    if unavailable:
+        return pd.DataFrame(), (f"“{measure}”需要{'和'.join(sources)}数据，"
+                                f"不能按只存在于{PIVOT_DIMENSIONS[unavailable[0]]}数据中的“{'、'.join(unavailable)}”汇总")
+
+    tables = []
+    for source in sources:
+        parts = [cube[source] for cube in (snapshot.pivot_cube(name) for name in partition_names) if cube is not None]
+        if not parts:
+            return pd.DataFrame(), "所选分区没有数据"
+        table = pd.concat(parts, ignore_index=True)
+        mask = np.zeros(len(table), dtype=bool)
+        mask[filter_index(table, regions, provinces, start_date, end_date)] = True
+        for dimension, values in pivot_filters.items():
+            if dimension in PIVOT_TIME_DIMENSIONS:
+                labels = table['发运月份'].dt.to_period(PIVOT_TIME_DIMENSIONS[dimension]).astype(str)
+                mask &= labels.isin(values).to_numpy()
+            else:
+                mask &= table[dimension].isin(values).to_numpy()
+        table = table[mask]
+        for dimension in dimensions:
+            if dimension in PIVOT_TIME_DIMENSIONS:
+                table = table.assign(**{dimension: table['发运月份'].dt.to_period(PIVOT_TIME_DIMENSIONS[dimension]).astype(str)})
+        values = ['物料数量', '物料总成本'] if source == '物料' else ['销售总额']
+        tables.append(table.groupby(dimensions, dropna=False, sort=True, observed=True)[values].sum().reset_index())
+
+    # 两边都是汇总后的结果，关联的行数只与维度组合数有关
+    result = tables[0] if len(tables) == 1 else pd.merge(tables[0], tables[1], on=dimensions, how='outer')
+    if result.empty:
+        return pd.DataFrame(), "当前筛选条件下没有数据"
+    if measure in ('费比', 'ROI'):
+        cost = result['物料总成本'].fillna(0).to_numpy(dtype=float)
+        sales = result['销售总额'].fillna(0).to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if measure == '费比':
+                result[measure] = np.where(sales > 0, cost / sales * 100, np.nan)
+            else:
+                result[measure] = np.where(cost > 0, (sales - cost) / cost, np.nan)
+
+    if not columns:
+        return result[list(rows) + [measure]].reset_index(drop=True), None
+    pivot = result.pivot(index=list(rows), columns=list(columns), values=measure)
+    if isinstance(pivot.columns, pd.MultiIndex):
+        pivot.columns = [' / '.join(map(str, column)) for column in pivot.columns]
+    else:
+        pivot.columns = pivot.columns.astype(str)
+    return pivot.reset_index(), None
+
+
+# 透视分析
+def pivot_analysis(snapshot, partition_names, filter_key, regions, provinces, start_date, end_date):
+    """透视分析"""
+    st.markdown("## 透视分析")
+
+    dimensions = list(PIVOT_DIMENSIONS)
+    cols = st.columns(3)
+    with cols[0]:
+        rows = st.multiselect("行维度:", dimensions, default=['申请人'], key="pivot_rows")
+    with cols[1]:
+        columns = st.multiselect("列维度:", [d for d in dimensions if d not in rows], default=['季度'],
+                                 key="pivot_columns")
+    with cols[2]:
+        measure = st.selectbox("指标:", list(PIVOT_MEASURES), index=2, key="pivot_measure")
+
+    filter_dimensions = st.multiselect("筛选维度:", dimensions, key="pivot_filter_dimensions")
+    pivot_filters = {}
+    if filter_dimensions:
+        filter_cols = st.columns(len(filter_dimensions))
+        for col, dimension in zip(filter_cols, filter_dimensions):
+            source = '销售' if PIVOT_DIMENSIONS[dimension] == '销售' else '物料'
+            cubes = [cube[source] for cube in (snapshot.pivot_cube(name) for name in partition_names) if cube is not None]
+            if dimension in PIVOT_TIME_DIMENSIONS:
+                options = sorted({str(p) for cube in cubes
+                                  for p in cube['发运月份'].dt.to_period(PIVOT_TIME_DIMENSIONS[dimension]).unique()})
+            else:
+                options = sorted({str(v) for cube in cubes for v in cube[dimension].dropna().unique()})
+            with col:
+                values = st.multiselect(f"{dimension}:", options, key=f"pivot_filter_{dimension}")
+            if values:
+                pivot_filters[dimension] = values
+
+    if not rows:
+        st.info("请至少选择一个行维度")
+        return
+
+    pivot_key = ('pivot', tuple(rows), tuple(columns), measure, tuple(sorted(
+        (dimension, tuple(sorted(values))) for dimension, values in pivot_filters.items()
+    )))
+    pivot, error = analysis_result(
+        filter_key, pivot_key,
+        lambda: compute_pivot(snapshot, partition_names, rows, columns, measure, pivot_filters,
+                              regions, provinces, start_date, end_date)
+    )
+    if error:
+        st.warning(error)
+        return
+
+    export_buttons("透视表", pivot, (filter_key or (None,)) + (pivot_key,))
+    value_format = {'费比': '{:.2f}%', 'ROI': '{:,.2f}', '物料数量': '{:,.0f}'}.get(measure, '￥{:,.2f}')
+    st.dataframe(
+        pivot.style.format({c: value_format for c in pivot.columns if c not in rows}, na_rep='-'),
+        use_container_width=True, hide_index=True
+    )
+    st.caption(f"共 {len(pivot):,} 行 × {len(pivot.columns) - len(rows):,} 列，"
+               "基于按月预先汇总的数据计算，受侧边栏区域、省份和日期筛选影响，不受图表联动筛选影响")
+
+
+# 多粒度时间序列分析
+def time_series_analysis(snapshot, regions, provinces, start_date, end_date, customers=None):
+    """按所选粒度和维度查看趋势，数据来自预先汇总的时间序列存储"""
+    st.markdown("### 多粒度趋势")
+
+    cols = st.columns(2)
+    with cols[0]:
+        resolution = st.selectbox("时间粒度:", list(TIME_SERIES_RESOLUTIONS), index=0)
+    with cols[1]:
+        dimension = st.selectbox("分析维度:", list(TIME_SERIES_DIMENSIONS), index=0)
+
+    by_customer = bool(customers) and dimension != '物料'
+    series_key = cross_filter_key(
+        make_filter_key(snapshot.dataset_version(snapshot.partition_names), regions, provinces, start_date, end_date),
+        {'客户代码': customers} if by_customer else {}
+    )
+    series = analysis_result(
+        series_key, ('time_series', resolution, dimension),
+        lambda: compute_time_series(snapshot, resolution, dimension, regions, provinces, start_date, end_date,
+                                    customers if by_customer else None)
+    )
+    if customers and not by_customer:
+        st.caption("物料维度的趋势来自不含客户的汇总数据，不受客户联动筛选影响")
+    if series.empty:
+        st.warning("没有足够的数据来生成多粒度趋势")
+        return
+
+    value = '物料总成本' if dimension == '物料' else '销售总额'
+    columns = TIME_SERIES_DIMENSIONS[dimension]
+    if columns:
+        # 按所选日期范围内的合计值选出排名前列的维度值
+        label = columns[-1]
+        totals = series.groupby(label)[value].sum().sort_values(ascending=False)
+        selected = st.multiselect(f"选择{dimension}:", options=totals.index.tolist(), default=totals.index[:5].tolist())
+        series = series[series[label].isin(selected)]
+        fig = px.line(series, x='周期', y=value, color=label, markers=True, title=f"各{dimension}{value}趋势（按{resolution}）")
+    else:
+        fig = px.line(series, x='周期', y=[value, f'{value}移动平均'], markers=True, title=f"{value}趋势（按{resolution}）")
+
+    fig.update_layout(
+        xaxis_title=resolution,
+        yaxis=dict(title=f"{value} (元)", tickprefix="￥", tickformat=",.2f"),
+        legend_title_text='',
+        height=450
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    metric_columns = [col for col in series.columns if col not in ('所属区域', '省份')]
+    formats = {col: '{:+.2f}%' for col in metric_columns if col.endswith(('环比', '同比'))}
+    formats.update({col: '￥{:,.2f}' for col in metric_columns if col.endswith(('销售总额', '物料总成本', '移动平均'))})
+    formats['费比'] = '{:.2f}%'
+    st.dataframe(
+        series[metric_columns].style.format({k: v for k, v in formats.items() if k in metric_columns}, na_rep='-'),
+        use_container_width=True, hide_index=True
+    )
+
+
+# 跨年同比分析
+def year_over_year_analysis(snapshot, regions, provinces, start_date, end_date, customers=None):
+    """跨年同比分析，上一年的数据可以来自未选中的分区"""
+    st.markdown("### 跨年同比")
+
+    yoy = compute_year_over_year(snapshot, regions, provinces, start_date, end_date, customers)
+    if yoy.empty or yoy['销售总额_去年'].isna().all():
+        st.info("所选日期范围没有上一年同期数据，无法进行同比分析")
+        return
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=yoy['月份'], y=yoy['销售总额'], name='本期销售额', marker_color='#1f77b4'))
+    fig.add_trace(go.Bar(x=yoy['月份'], y=yoy['销售总额_去年'], name='去年同期销售额', marker_color='#aec7e8'))
+    fig.update_layout(
+        title_text="月度销售额同比",
+        barmode='group',
+        xaxis_title="月份",
+        yaxis=dict(title="销售总额 (元)", tickprefix="￥", tickformat=",.2f"),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        height=400
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    table = yoy[['月份', '销售总额', '销售总额_去年', '销售额同比', '物料总成本', '物料总成本_去年', '物料成本同比',
+                 '费比', '费比_去年']].rename(columns={
+        '销售总额_去年': '去年同期销售额',
+        '物料总成本_去年': '去年同期物料成本',
+        '费比_去年': '去年同期费比'
+    })
+    st.dataframe(table.style.format({
+        '销售总额': '￥{:,.2f}',
+        '去年同期销售额': '￥{:,.2f}',
+        '销售额同比': '{:+.2f}%',
+        '物料总成本': '￥{:,.2f}',
+        '去年同期物料成本': '￥{:,.2f}',
+        '物料成本同比': '{:+.2f}%',
+        '费比': '{:.2f}%',
+        '去年同期费比': '{:.2f}%'
+    }, na_rep='-'), use_container_width=True)
+
+
+# 计算客户价值
+def compute_customer_value(filtered_material, filtered_sales, engine=None):
+    """按客户汇总并计算费比、物料效率、客户价值和ROI，剔除无效行"""
+    if resolve_engine(engine) == "polars":
+        return _customer_value_polars(filtered_material, filtered_sales)
 
     # 按客户聚合数据
     customer_material = filtered_material.groupby(['客户代码', '经销商名称']).agg({
@@ -871,9 +2836,307 @@ def customer_analysis(filtered_material, filtered_sales):
         customer_value.loc[mask, 'ROI'] = (customer_value.loc[mask, '销售总额'] - customer_value.loc[
             mask, '物料总成本']) / customer_value.loc[mask, '物料总成本']
 
-    # 删除任何无效行
-    customer_value = customer_value.replace([np.inf, -np.inf], np.nan).dropna(
-        subset=['ROI', '费比', '物料效率', '客户价值'])
+    # 删除任何无效行
+    customer_value = customer_value.replace([np.inf, -np.inf], np.nan).dropna(
+        subset=['ROI', '费比', '物料效率', '客户价值'])
+
+    return customer_value
+
+
+# 计算客户同期群
+def compute_customer_cohorts(filtered_material, filtered_sales, start_date=None):
+    """按客户首次领用物料的月份分组（同期群），统计各同期群在之后第k个月的留存率（当月有销售的客户占比）、
+    累计销售额和累计费比。客户和月份先转换为整数编码，同期群×月龄矩阵由np.bincount一次计算，不逐个同期群循环。
+    传入的数据不应按起始日期筛选，客户的首次领用月份才是真实的；start_date之前的活动只用于划分同期群，
+    不计入各格，累计值从start_date所在月份起累计。
+    返回 (同期群规模, 留存率, 累计销售额, 累计费比)，矩阵的行为所选范围内有活动的同期群，列为月龄，
+    不在所选范围或超出数据范围的格为NaN"""
+    material_months = filtered_material['发运月份'].to_numpy(dtype='datetime64[M]')
+    sales_months = filtered_sales['发运月份'].to_numpy(dtype='datetime64[M]')
+    valid_material = ~np.isnat(material_months) & filtered_material['客户代码'].notna().to_numpy()
+    if not valid_material.any():
+        return tuple(pd.DataFrame() for _ in range(4))
+
+    # 客户编码在物料和销售数据之间共用
+    customer_codes, customers = pd.factorize(
+        np.concatenate([filtered_material['客户代码'].to_numpy(), filtered_sales['客户代码'].to_numpy()])
+    )
+    material_customer = customer_codes[:len(filtered_material)]
+    sales_customer = customer_codes[len(filtered_material):]
+
+    # 月份编码：相对最早物料月份的月数
+    first_month = material_months[valid_material].min()
+    material_month = (material_months - first_month).astype(int)
+    sales_month = (sales_months - first_month).astype(int)
+    last_month = max(material_month[valid_material].max(), sales_month[~np.isnat(sales_months)].max(initial=0))
+    n_months = int(last_month) + 1
+    start_month = 0
+    if start_date is not None:
+        start_month = max(int((np.datetime64(pd.Timestamp(start_date), 'M') - first_month).astype(int)), 0)
+
+    # 每个客户的同期群（首次领用物料的月份），没有领用物料的客户为-1
+    cohort = np.full(len(customers), n_months, dtype=np.int64)
+    np.minimum.at(cohort, material_customer[valid_material], material_month[valid_material])
+    cohort[cohort == n_months] = -1
+
+    def cell_index(customer, month, valid):
+        """行所在的 (同期群, 月龄) 平铺位置，以及该行是否计入（属于某同期群、不早于首次领用且在所选范围内）"""
+        row_cohort = cohort[customer]
+        age = month - row_cohort
+        keep = valid & (customer >= 0) & (row_cohort >= 0) & (age >= 0) & (month >= start_month)
+        return row_cohort[keep] * n_months + age[keep], keep
+
+    size = n_months * n_months
+    cost_index, cost_keep = cell_index(material_customer, material_month, valid_material)
+    # 没有生效单价的物料成本为空，不计入合计
+    material_cost = np.nan_to_num(filtered_material['物料总成本'].to_numpy(dtype=float))
+    cost = np.bincount(cost_index, weights=material_cost[cost_keep], minlength=size)
+
+    valid_sales = ~np.isnat(sales_months)
+    sales_index, sales_keep = cell_index(sales_customer, sales_month, valid_sales)
+    sales_amount = np.nan_to_num(filtered_sales['销售总额'].to_numpy(dtype=float))
+    sales = np.bincount(sales_index, weights=sales_amount[sales_keep], minlength=size)
+
+    # 活跃客户数：同一客户同一月份只计一次
+    active_pairs = np.unique(sales_customer[sales_keep].astype(np.int64) * n_months + sales_month[sales_keep])
+    active_index, _ = cell_index(active_pairs // n_months, active_pairs % n_months, np.ones(len(active_pairs), dtype=bool))
+    active = np.bincount(active_index, minlength=size)
+
+    cohort_size = np.bincount(cohort[cohort >= 0], minlength=n_months)
+    cost = cost.reshape(n_months, n_months)
+    sales = sales.reshape(n_months, n_months)
+    active = active.reshape(n_months, n_months)
+
+    cumulative_cost = np.cumsum(cost, axis=1)
+    cumulative_sales = np.cumsum(sales, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        retention = active / cohort_size[:, None] * 100
+        cumulative_fee_ratio = np.where(cumulative_sales > 0, cumulative_cost / cumulative_sales * 100, np.nan)
+
+    # 只保留在所选范围内有活动的同期群，不在所选范围或超过数据范围的格置为NaN
+    rows = np.flatnonzero((cohort_size > 0) & ((active.sum(axis=1) > 0) | (cost.sum(axis=1) > 0)))
+    calendar_month = rows[:, None] + np.arange(n_months)[None, :]
+    observable = (calendar_month >= start_month) & (calendar_month <= last_month)
+    labels = [str(month) for month in (first_month + rows.astype('timedelta64[M]'))]
+    ages = [f'第{age}月' for age in range(n_months)]
+
+    def matrix(values):
+        values = np.where(observable, values[rows], np.nan)
+        return pd.DataFrame(values, index=pd.Index(labels, name='同期群'), columns=ages)
+
+    sizes = pd.DataFrame({'同期群': labels, '客户数': cohort_size[rows]})
+    return sizes, matrix(retention), matrix(cumulative_sales), matrix(cumulative_fee_ratio)
+
+
+# 物料推荐
+def compute_material_recommendations(filtered_material, filtered_sales, weight='物料数量',
+                                     top_n=RECOMMENDATION_TOP_N):
+    """基于物料的协同过滤：构造 [客户, 物料] 稀疏矩阵（权重为物料数量，或按成本占比分摊的当月销售额），
+    用稀疏矩阵乘法求物料间余弦相似度，再以客户的物料组合（按行归一化）乘以相似度矩阵，
+    一次算出所有客户对未使用物料的推荐得分，每个客户保留得分最高的top_n个物料"""
+    usage = filtered_material[['客户代码', '发运月份', '物料代码', '物料数量', '物料总成本']]
+    usage = usage[usage['客户代码'].notna() & usage['物料代码'].notna()]
+    if weight == '归因销售额':
+        # 客户当月销售额按各物料成本占比分摊
+        month_cost = usage.groupby(['客户代码', '发运月份'])['物料总成本'].transform('sum')
+        month_sales = pd.merge(
+            usage[['客户代码', '发运月份']],
+            filtered_sales.groupby(['客户代码', '发运月份'])['销售总额'].sum().reset_index(),
+            on=['客户代码', '发运月份'], how='left'
+        )['销售总额'].to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = month_sales * usage['物料总成本'].to_numpy(dtype=float) / month_cost.to_numpy(dtype=float)
+    else:
+        values = usage['物料数量'].to_numpy(dtype=float)
+    values = np.maximum(np.nan_to_num(values), 0)
+
+    customer_index, customers = pd.factorize(usage['客户代码'])
+    material_index, materials = pd.factorize(usage['物料代码'])
+    if len(customers) == 0 or len(materials) < 2:
+        return pd.DataFrame()
+
+    # 重复的 (客户, 物料) 在转换为CSR时自动求和；权重为0的记录（如当月无销售）也算作已使用
+    shape = (len(customers), len(materials))
+    matrix = scipy_sparse.csr_matrix((values, (customer_index, material_index)), shape=shape)
+    matrix.eliminate_zeros()
+    used = scipy_sparse.csr_matrix((np.ones(len(values)), (customer_index, material_index)), shape=shape) > 0
+
+    # 物料间余弦相似度，去掉物料与自身的相似度
+    column_norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    with np.errstate(divide='ignore'):
+        normalized = matrix @ scipy_sparse.diags(np.where(column_norms > 0, 1 / column_norms, 0))
+    similarity = (normalized.T @ normalized).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+
+    # 客户物料组合按行归一化后与相似度相乘，得到所有客户的推荐得分，再去掉已使用的物料
+    row_sums = np.asarray(matrix.sum(axis=1)).ravel()
+    with np.errstate(divide='ignore'):
+        profile = scipy_sparse.diags(np.where(row_sums > 0, 1 / row_sums, 0)) @ matrix
+    scores = (profile @ similarity).tocsr()
+    scores = (scores - scores.multiply(used)).tocoo()
+    keep = scores.data > 0
+    rows, cols, data = scores.row[keep], scores.col[keep], scores.data[keep]
+    if len(data) == 0:
+        return pd.DataFrame()
+
+    # 每个客户内按得分降序排名，保留前top_n个
+    order = np.lexsort((-data, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+    row_start = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(customers)))])
+    rank = np.arange(len(rows)) - row_start[rows] + 1
+    top = rank <= top_n
+
+    names = filtered_material.drop_duplicates('物料代码').set_index('物料代码')['物料名称']
+    dealers = filtered_material.drop_duplicates('客户代码').set_index('客户代码')['经销商名称']
+    users = np.asarray(used.sum(axis=0)).ravel()
+    recommendations = pd.DataFrame({
+        '客户代码': customers[rows[top]],
+        '推荐排名': rank[top],
+        '物料代码': materials[cols[top]],
+        '推荐得分': data[top],
+        '使用客户数': users[cols[top]]
+    })
+    recommendations.insert(1, '经销商名称', recommendations['客户代码'].map(dealers))
+    recommendations.insert(4, '物料名称', recommendations['物料代码'].map(names))
+    return recommendations
+
+
+# 物料推荐分析
+def material_recommendation_analysis(filtered_material, filtered_sales, filter_key=None):
+    """物料推荐分析"""
+    st.markdown("### 经销商物料推荐")
+
+    cols = st.columns(2)
+    with cols[1]:
+        weight = st.radio("相似度权重:", ["物料数量", "归因销售额"], horizontal=True)
+    recommendations = analysis_result(
+        filter_key, ('material_recommendation', weight),
+        lambda: compute_material_recommendations(filtered_material, filtered_sales, weight)
+    )
+    if recommendations.empty:
+        st.warning("没有足够的数据来生成物料推荐")
+        return
+
+    dealers = recommendations.drop_duplicates('客户代码')
+    with cols[0]:
+        customer = st.selectbox(
+            "选择经销商:", dealers['客户代码'],
+            format_func=dict(zip(dealers['客户代码'], dealers['经销商名称'].fillna(dealers['客户代码']))).get
+        )
+
+    used = filtered_material[filtered_material['客户代码'] == customer].groupby(['物料代码', '物料名称']).agg({
+        '物料数量': 'sum',
+        '物料总成本': 'sum'
+    }).reset_index().sort_values('物料总成本', ascending=False)
+
+    cols = st.columns(2)
+    with cols[0]:
+        st.markdown("**推荐物料**")
+        st.dataframe(
+            recommendations.loc[recommendations['客户代码'] == customer,
+                                ['推荐排名', '物料代码', '物料名称', '推荐得分', '使用客户数']]
+            .style.format({'推荐得分': '{:.3f}'}),
+            use_container_width=True, hide_index=True
+        )
+    with cols[1]:
+        st.markdown("**已使用物料**")
+        st.dataframe(used.style.format({'物料数量': '{:,.0f}', '物料总成本': '￥{:,.2f}'}),
+                     use_container_width=True, hide_index=True)
+
+    st.markdown("""
+    **图表解读：**
+    - 推荐物料是该经销商尚未使用、但与其已使用物料经常被相同客户搭配使用的物料，得分越高关联越强。
+    - 按物料数量加权反映搭配使用的习惯；按归因销售额加权时，与高销售额客户的物料组合更相似的物料得分更高。
+    - 使用客户数较少的物料推荐依据有限，可结合物料效益分析中的ROI一并判断。
+    """)
+
+
+# 客户同期群分析
+def customer_cohort_analysis(snapshot, regions, provinces, start_date, end_date, customers=None):
+    """客户同期群分析。客户的首次领用月份取自截至结束日期的全部分区（可以来自未选中的分区），
+    只有所选日期范围内的活动计入各格；customers为联动筛选的客户，只统计这些客户"""
+    st.markdown("### 客户同期群分析")
+
+    history_names = [
+        partition['name'] for partition in snapshot.registry['partitions'] if partition['start'] <= end_date
+    ]
+    version = snapshot.dataset_version(history_names)
+    history_key = make_filter_key(version, regions, provinces, None, end_date)
+    cross_filters = {'客户代码': customers} if customers else {}
+
+    def compute():
+        df_material, df_sales, _ = snapshot.frames(history_names)
+        if df_material is None:
+            return tuple(pd.DataFrame() for _ in range(4))
+        return compute_customer_cohorts(
+            apply_cross_filters(history_key, '物料', filter_data(df_material, regions, provinces, None, end_date),
+                                cross_filters),
+            apply_cross_filters(history_key, '销售', filter_data(df_sales, regions, provinces, None, end_date),
+                                cross_filters),
+            start_date
+        )
+
+    filter_key = cross_filter_key(make_filter_key(version, regions, provinces, start_date, end_date), cross_filters)
+    sizes, retention, cumulative_sales, cumulative_fee_ratio = analysis_result(filter_key, 'customer_cohort', compute)
+    if sizes.empty or len(sizes) < 2:
+        st.warning("没有足够的数据来进行同期群分析")
+        return
+
+    metric = st.radio("同期群指标:", ["留存率", "累计销售额", "累计费比"], horizontal=True)
+    matrix, color_label, text_format = {
+        "留存率": (retention, "留存率 (%)", '.1f'),
+        "累计销售额": (cumulative_sales, "累计销售额 (元)", ',.0f'),
+        "累计费比": (cumulative_fee_ratio, "累计费比 (%)", '.2f')
+    }[metric]
+    matrix = matrix.dropna(axis=1, how='all')
+    cohort_table = matrix.reset_index()
+    cohort_table.insert(1, '客户数', sizes['客户数'].to_numpy())
+    export_buttons(f"客户同期群{metric}", cohort_table, filter_key)
+
+    fig = px.imshow(
+        matrix,
+        labels=dict(x="月龄", y="首次领用物料月份", color=color_label),
+        x=matrix.columns,
+        y=[f"{label}（{count}户）" for label, count in zip(sizes['同期群'], sizes['客户数'])],
+        color_continuous_scale="Blues" if metric != "累计费比" else "RdYlGn_r",
+        title=f"客户同期群{metric}",
+        text_auto=text_format,
+        aspect='auto'
+    )
+    fig.update_layout(height=max(400, 32 * len(matrix) + 150))
+    st.plotly_chart(fig, use_container_width=True)
+
+    st.markdown("""
+    **图表解读：**
+    - 每一行是在同一个月首次领用物料的客户（同期群），括号内为客户数；每一列是首次领用后的第几个月。
+    - 首次领用月份按截至结束日期的全部数据确定，格中只统计所选日期范围内的活动，早于范围的月份留空。
+    - 留存率为该月仍有销售的客户占同期群客户数的比例，反映物料投放后客户的持续活跃程度。
+    - 累计销售额和累计费比展示同期群在所选范围内的累计产出和投入产出效率。
+    - 比较不同同期群在相同月龄的表现，可以评估不同时期物料投放策略的效果。
+    """)
+
+
+# 客户价值分析
+def customer_analysis(filtered_material, filtered_sales, filter_key=None):
+    """客户价值分析"""
+    st.markdown("## 客户价值分析")
+
+    customer_value = analysis_result(
+        filter_key, 'customer', lambda: compute_customer_value(filtered_material, filtered_sales)
+    )
+    export_buttons("客户价值", customer_value, filter_key)
+    with st.expander(f"浏览全部 {len(customer_value):,} 个客户"):
+        paginated_table("客户价值", customer_value, filter_key, search_columns=('客户代码', '经销商名称'),
+                        default_sort='客户价值', formats={
+                            '物料总成本': '￥{:,.2f}',
+                            '物料数量': '{:,.0f}',
+                            '销售总额': '￥{:,.2f}',
+                            '费比': '{:.2f}%',
+                            '物料效率': '{:,.2f}',
+                            '客户价值': '{:,.2f}',
+                            'ROI': '{:,.2f}'
+                        })
 
     # 创建客户价值分布图
     cols = st.columns(2)
@@ -941,6 +3204,7 @@ def customer_analysis(filtered_material, filtered_sales):
                     size='ROI_display',
                     color='费比_display',
                     hover_name='经销商名称',
+                    custom_data=['客户代码'],
                     title="客户ROI矩阵",
                     labels={
                         '物料总成本': '物料总成本 (元)',
@@ -972,12 +3236,15 @@ def customer_analysis(filtered_material, filtered_sales):
                     yaxis=dict(tickprefix="￥", type="log", tickformat=",.2f")  # 修改为保留两位小数
                 )
 
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(fig, use_container_width=True, key='chart_customer_roi',
+                                selection_mode=('points', 'box', 'lasso'),
+                                on_select=lambda: select_cross_filter('chart_customer_roi'))
 
                 # 客户ROI矩阵解读更新
                 st.markdown("""
                 **图表解读：**
                 - 散点图展示了客户的投入(物料成本)与产出(销售额)关系。
+                - 点击或框选客户可将其他分析筛选为所选客户。
                 - 点的大小表示ROI(投资回报率)，计算公式为(销售额-物料成本)/物料成本，越大表示回报率越高。
                 - 点的颜色表示费比，颜色越浅表示物料使用效率越高。
                 - 红色虚线是销售额=物料成本的参考线，点位于此线上方表示有正向回报，位于线下方表示投入大于产出。
@@ -1214,10 +3481,11 @@ def customer_analysis(filtered_material, filtered_sales):
             st.info("客户分群需要更多有效数据。")
 
 
-# 物料效益分析
-def material_analysis(filtered_material, filtered_sales):
-    """物料效益分析"""
-    st.markdown("## 物料效益分析")
+# 计算物料ROI
+def compute_material_roi(filtered_material, filtered_sales, engine=None):
+    """按物料汇总成本与同月同客户的关联销售额，计算ROI"""
+    if resolve_engine(engine) == "polars":
+        return _material_roi_polars(filtered_material, filtered_sales)
 
     # 按物料分组，计算ROI
     material_metrics = filtered_material.groupby(['物料代码', '物料名称']).agg({
@@ -1248,12 +3516,393 @@ def material_analysis(filtered_material, filtered_sales):
         material_roi.loc[mask, 'ROI'] = (material_roi.loc[mask, '销售总额'] - material_roi.loc[mask, '物料总成本']) / \
                                         material_roi.loc[mask, '物料总成本']
 
+    return material_roi
+
+
+# 计算物料ROI置信区间
+def compute_material_roi_ci(filtered_material, filtered_sales):
+    """以物料记录为观测单元（成本与该客户当月销售额，与compute_material_roi的关联口径一致），
+    自助法估计每个物料投入产出比的95%置信区间，ROI区间为投入产出比区间减1"""
+    customer_month_sales = filtered_sales.groupby(['发运月份', '客户代码'])['销售总额'].sum().reset_index()
+    units = pd.merge(
+        filtered_material[['发运月份', '客户代码', '物料代码', '物料名称', '物料总成本']],
+        customer_month_sales,
+        on=['发运月份', '客户代码'],
+        how='left'
+    )
+    ratio = bootstrap_ratio_ci(
+        pd.MultiIndex.from_frame(units[['物料代码', '物料名称']]), units['销售总额'], units['物料总成本']
+    )
+    return pd.DataFrame({
+        '物料代码': ratio.index.get_level_values(0),
+        '物料名称': ratio.index.get_level_values(1),
+        '观测数': ratio['观测数'].to_numpy(),
+        '投入产出比下限': ratio['下限'].to_numpy(),
+        '投入产出比上限': ratio['上限'].to_numpy(),
+        'ROI下限': ratio['下限'].to_numpy() - 1,
+        'ROI上限': ratio['上限'].to_numpy() - 1
+    })
+
+
+# 分组回归物料边际回报
+def compute_marginal_roi(filtered_material, filtered_sales, by_region=False):
+    """对每个物料（by_region时为物料×区域）用客户-月份样本拟合 销售额 = a + b·z + c·z²，z为标准化后的物料投入。
+    所有分组的充分统计量由np.bincount一次求出，3×3正规方程按分组堆叠后一次批量求解，不逐组循环拟合。
+    返回每组的样本数、平均投入、平均投入处每多投入1元带来的边际销售额及其95%置信区间、边际ROI、
+    饱和投入（二次项为负时边际销售额降为0的投入）和R²"""
+    keys = ['物料代码', '物料名称'] + (['所属区域'] if by_region else [])
+
+    # 样本：每个分组、客户、月份的物料投入，以及该客户当月的销售额（没有销售时为0）
+    spend = filtered_material.groupby(keys + ['客户代码', '发运月份'])['物料总成本'].sum().reset_index()
+    sales = filtered_sales.groupby(['客户代码', '发运月份'])['销售总额'].sum().reset_index()
+    samples = pd.merge(spend, sales, on=['客户代码', '发运月份'], how='left')
+    samples = samples[samples['物料总成本'] > 0]
+    if samples.empty:
+        return pd.DataFrame()
+
+    group, groups = pd.factorize(pd.MultiIndex.from_frame(samples[keys]))
+    n_groups = len(groups)
+    x = samples['物料总成本'].to_numpy(dtype=float)
+    y = np.nan_to_num(samples['销售总额'].to_numpy(dtype=float))
+
+    def group_sum(values):
+        return np.bincount(group, weights=values, minlength=n_groups)
+
+    # 按组标准化投入，避免x的高次幂数值过大
+    n = np.bincount(group, minlength=n_groups).astype(float)
+    mean_x = group_sum(x) / n
+    std_x = np.sqrt(np.maximum(group_sum(x * x) / n - mean_x ** 2, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.nan_to_num((x - mean_x[group]) / std_x[group])
+
+    # 正规方程 XᵀX·θ = Xᵀy，X = [1, z, z²]
+    z2 = z * z
+    moments = [n] + [group_sum(z ** k) for k in range(1, 5)]
+    xtx = np.stack([
+        np.stack([moments[0], moments[1], moments[2]], axis=-1),
+        np.stack([moments[1], moments[2], moments[3]], axis=-1),
+        np.stack([moments[2], moments[3], moments[4]], axis=-1)
+    ], axis=1)
+    xty = np.stack([group_sum(y), group_sum(z * y), group_sum(z2 * y)], axis=-1)
+    xtx_inv = np.linalg.pinv(xtx)
+    theta = np.einsum('gij,gj->gi', xtx_inv, xty)
+
+    # 残差平方和 = Σy² - θᵀXᵀy，回归系数协方差 = σ²(XᵀX)⁻¹
+    sum_y = group_sum(y)
+    rss = np.maximum(group_sum(y * y) - np.einsum('gi,gi->g', theta, xty), 0)
+    tss = group_sum(y * y) - sum_y ** 2 / n
+    dof = n - 3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma2 = np.where(dof > 0, rss / dof, np.nan)
+        slope = theta[:, 1] / std_x
+        slope_se = np.sqrt(sigma2 * xtx_inv[:, 1, 1]) / std_x
+        r2 = np.where(tss > 0, 1 - rss / tss, np.nan)
+        saturation = np.where(theta[:, 2] < 0, mean_x - theta[:, 1] / (2 * theta[:, 2]) * std_x, np.nan)
+
+    # 样本太少或投入没有变化的分组无法估计斜率
+    valid = (dof > 0) & (std_x > 0)
+    slope = np.where(valid, slope, np.nan)
+    slope_se = np.where(valid, slope_se, np.nan)
+
+    marginal = pd.DataFrame(list(groups), columns=keys)
+    marginal['样本数'] = n.astype(int)
+    marginal['平均投入'] = mean_x
+    marginal['边际销售额'] = slope
+    marginal['置信下限'] = slope - 1.96 * slope_se
+    marginal['置信上限'] = slope + 1.96 * slope_se
+    marginal['边际ROI'] = slope - 1
+    marginal['饱和投入'] = np.where(valid & (saturation > 0), saturation, np.nan)
+    marginal['R²'] = np.where(valid, r2, np.nan)
+    return marginal.sort_values('边际ROI', ascending=False, na_position='last').reset_index(drop=True)
+
+
+# 物料边际回报分析
+def marginal_roi_analysis(filtered_material, filtered_sales, filter_key=None):
+    """物料边际回报分析"""
+    st.markdown("### 物料边际回报")
+
+    by_region = st.radio("拟合分组:", ["按物料", "按物料×区域"], horizontal=True) == "按物料×区域"
+    marginal = analysis_result(
+        filter_key, ('marginal_roi', by_region),
+        lambda: compute_marginal_roi(filtered_material, filtered_sales, by_region)
+    )
+    if marginal.empty or marginal['边际销售额'].isna().all():
+        st.warning("没有足够的数据来拟合物料边际回报")
+        return
+
+    fitted = marginal.dropna(subset=['边际销售额'])
+    export_buttons("物料边际回报", fitted, (filter_key or (None,)) + (('marginal_roi', by_region),))
+    top = fitted.head(15).copy()
+    top['名称'] = top['物料名称'] + (' - ' + top['所属区域'].astype(str) if by_region else '')
+    fig = go.Figure(go.Bar(
+        x=top['名称'],
+        y=top['边际销售额'],
+        error_y=dict(type='data', symmetric=False,
+                     array=top['置信上限'] - top['边际销售额'],
+                     arrayminus=top['边际销售额'] - top['置信下限']),
+        marker_color='#1f77b4'
+    ))
+    fig.add_hline(y=1, line_dash="dash", line_color="red", annotation_text="边际销售额 = 1（盈亏平衡）")
+    fig.update_layout(
+        title_text="边际销售额TOP15（每多投入1元物料带来的销售额，含95%置信区间）",
+        xaxis=dict(tickangle=-45),
+        yaxis_title="边际销售额 (元/元)",
+        height=500
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    st.dataframe(fitted.style.format({
+        '平均投入': '￥{:,.2f}',
+        '边际销售额': '{:,.2f}',
+        '置信下限': '{:,.2f}',
+        '置信上限': '{:,.2f}',
+        '边际ROI': '{:,.2f}',
+        '饱和投入': '￥{:,.2f}',
+        'R²': '{:.3f}'
+    }, na_rep='-'), use_container_width=True, hide_index=True)
+
+    st.markdown("""
+    **图表解读：**
+    - 边际销售额是在该物料当前平均投入水平上，每多投入1元物料，同月该客户销售额的平均变化，由客户-月份样本拟合得到。
+    - 置信区间跨过1的物料，无法确定追加投入是否有正向回报；样本数较少的物料置信区间通常较宽。
+    - 饱和投入为拟合曲线开始下降的投入水平，平均投入已接近饱和投入的物料追加投入效果有限。
+    - 此分析反映相关性，客户规模等因素也会同时影响投入和销售额。
+    """)
+
+
+# 预算分配优化
+def compute_budget_allocation(marginal, total_budget, bound_column=None, bounds=None,
+                              max_multiple=BUDGET_MAX_MULTIPLE):
+    """在总预算和分组上下限约束下，为每个物料×区域分配预算，使预计销售额最大。
+    响应曲线来自compute_marginal_roi(by_region=True)：边际销售额在平均投入处为拟合值，
+    二次项为负时随投入线性下降、在饱和投入处降为0，否则保持不变。每条曲线在[0, 当前投入×max_multiple]
+    上切成BUDGET_SEGMENTS段，边际销售额逐段递减，且只有一个总预算约束，因此按边际销售额从高到低依次填满各段即为最优解；
+    有上下限时先为每个设限分组填入其最优的段直到下限，再在各分组剩余额度内依次填充，同样是最优解。
+    无法拟合的分组保持当前投入不变。bounds为 {bound_column取值: (下限, 上限)}，约束该取值下所有分组的投入合计。
+    返回 (分配结果, 错误信息)，求解成功时错误信息为None"""
+    n = marginal['样本数'].to_numpy(dtype=float)
+    mean_x = marginal['平均投入'].to_numpy(dtype=float)
+    current = n * mean_x
+    fitted = marginal['边际销售额'].notna().to_numpy()
+    free_budget = total_budget - current[~fitted].sum()
+
+    # 每段的宽度和段中点处每1元投入的边际销售额，形状为 [分组, 段]
+    m0 = marginal['边际销售额'].to_numpy(dtype=float)[fitted]
+    saturation = marginal['饱和投入'].to_numpy(dtype=float)[fitted]
+    n, mean_x = n[fitted], mean_x[fitted]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(np.isnan(saturation) | (saturation == mean_x), 0, -m0 / (saturation - mean_x))
+    slope = np.minimum(slope, 0)
+    width = current[fitted] * max_multiple / BUDGET_SEGMENTS
+    start = width[:, None] * np.arange(BUDGET_SEGMENTS)
+    value = m0[:, None] + slope[:, None] * ((start + width[:, None] / 2) / n[:, None] - mean_x[:, None])
+
+    n_groups = len(m0)
+    infeasible = "在当前总预算和上下限约束下没有可行的分配方案，请放宽上下限或调整总预算"
+
+    # 每段所属的设限分组（-1表示不设限）及各设限分组的下限、上限（已扣除无法拟合分组的固定投入）
+    segment_row = np.full(n_groups * BUDGET_SEGMENTS, -1)
+    lower, upper = np.zeros(0), np.zeros(0)
+    if bound_column and bounds:
+        names, group_name = np.unique(marginal.loc[fitted, bound_column].astype(str), return_inverse=True)
+        fixed_by_name = marginal.loc[~fitted].groupby(marginal.loc[~fitted, bound_column].astype(str)) \
+            .apply(lambda g: (g['样本数'] * g['平均投入']).sum())
+        row_of_name = np.full(len(names), -1)
+        lower, upper = [], []
+        for i, name in enumerate(names):
+            if name not in bounds:
+                continue
+            low, high = bounds[name]
+            fixed = fixed_by_name.get(name, 0.0)
+            row_of_name[i] = len(lower)
+            lower.append(max(low - fixed, 0.0))
+            upper.append(high - fixed)
+        lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+        segment_row = np.repeat(row_of_name[group_name], BUDGET_SEGMENTS)
+
+    # 所有段按边际销售额从高到低排序；同一分组内各段本身递减，排序后仍按顺序填充
+    order = np.argsort(-value.ravel(), kind='stable')
+    sorted_width = np.repeat(width, BUDGET_SEGMENTS)[order]
+    sorted_row = segment_row[order]
+    bounded = sorted_row >= 0
+
+    def fill_within(cap):
+        """在每个设限分组的额度cap内，按排序顺序可填入各段的宽度（不设限的段不受影响）"""
+        available = sorted_width.copy()
+        rows, widths = sorted_row[bounded], sorted_width[bounded]
+        # 各设限分组内按排序顺序的累计宽度
+        group_order = np.argsort(rows, kind='stable')
+        cumulative = np.empty(len(rows))
+        cumulative[group_order] = np.cumsum(widths[group_order])
+        offsets = np.concatenate([[0.0], np.cumsum(np.bincount(rows, weights=widths, minlength=len(cap)))])
+        cumulative -= offsets[rows]
+        available[bounded] = np.clip(cap[rows] - (cumulative - widths), 0, widths)
+        return available
+
+    # 先为设限分组填入最优的段直到下限，再在剩余额度内全局按边际销售额依次填充
+    prefill = np.zeros(len(order))
+    if len(lower):
+        if (upper < lower).any() or (np.bincount(sorted_row[bounded], weights=sorted_width[bounded],
+                                                 minlength=len(lower)) < lower).any():
+            return pd.DataFrame(), infeasible
+        prefill = fill_within(lower)
+        prefill[~bounded] = 0
+        sorted_width = sorted_width - prefill
+        available = fill_within(upper - lower)
+    else:
+        available = sorted_width
+    remaining = free_budget - prefill.sum()
+    if remaining < 0 or remaining > available.sum() * (1 + 1e-12):
+        return pd.DataFrame(), infeasible
+    taken = np.clip(remaining - (np.cumsum(available) - available), 0, available)
+
+    fill = np.empty(len(order))
+    fill[order] = prefill + taken
+    fill = fill.reshape(n_groups, BUDGET_SEGMENTS)
+    current_fill = np.clip(current[fitted][:, None] - start, 0, width[:, None])
+    allocation = marginal[[c for c in ['物料代码', '物料名称', '所属区域'] if c in marginal.columns]].copy()
+    allocation['当前投入'] = current
+    allocation['建议投入'] = current
+    allocation.loc[fitted, '建议投入'] = fill.sum(axis=1)
+    allocation['投入变化'] = allocation['建议投入'] - allocation['当前投入']
+    allocation['边际销售额'] = marginal['边际销售额']
+    allocation['预计销售额变化'] = 0.0
+    allocation.loc[fitted, '预计销售额变化'] = ((fill - current_fill) * value).sum(axis=1)
+    return allocation, None
+
+
+# 预算优化分析
+def budget_optimizer_analysis(filtered_material, filtered_sales, filter_key=None):
+    """预算优化分析"""
+    st.markdown("## 预算优化")
+
+    marginal = analysis_result(
+        filter_key, ('marginal_roi', True), lambda: compute_marginal_roi(filtered_material, filtered_sales, True)
+    )
+    if marginal.empty or marginal['边际销售额'].isna().all():
+        st.warning("没有足够的数据来拟合物料响应曲线，无法进行预算优化")
+        return
+
+    current_total = float((marginal['样本数'] * marginal['平均投入']).sum())
+    cols = st.columns(3)
+    with cols[0]:
+        total_budget = st.number_input("总预算 (元):", min_value=0.0, value=float(round(current_total)), step=10000.0,
+                                       format="%.0f")
+    with cols[1]:
+        max_multiple = st.number_input("单个物料×区域投入上限 (当前投入的倍数):", min_value=1.0, max_value=10.0,
+                                       value=BUDGET_MAX_MULTIPLE, step=0.5)
+    with cols[2]:
+        bound_by = st.radio("分组上下限:", ["按区域", "按物料"], horizontal=True)
+
+    # 分组当前投入沿用区域分析和物料效益分析的汇总结果
+    if bound_by == "按区域":
+        _, region_metrics = analysis_result(
+            filter_key, 'region', lambda: compute_region_metrics(filtered_material, filtered_sales)
+        )
+        spend = region_metrics[['所属区域', '物料总成本']].rename(columns={'所属区域': '分组'})
+        bound_column = '所属区域'
+    else:
+        material_roi = analysis_result(
+            filter_key, 'material_roi', lambda: compute_material_roi(filtered_material, filtered_sales)
+        )
+        spend = material_roi[['物料代码', '物料名称', '物料总成本']].rename(columns={'物料代码': '分组'})
+        bound_column = '物料代码'
+    spend = spend[spend['物料总成本'].fillna(0) > 0].rename(columns={'物料总成本': '当前投入'})
+    spend['下限 (%)'] = 50.0
+    spend['上限 (%)'] = 150.0
+
+    st.caption("各分组投入合计的上下限，以当前投入的百分比表示；清空某行的上下限即不对该分组设限")
+    edited = st.data_editor(
+        spend, key=f"budget_bounds_{bound_by}", use_container_width=True, hide_index=True,
+        disabled=[c for c in spend.columns if c not in ('下限 (%)', '上限 (%)')],
+        column_config={'当前投入': st.column_config.NumberColumn(format="￥%.0f")}
+    )
+    bounds = {
+        str(row['分组']): (
+            row['当前投入'] * (row['下限 (%)'] if pd.notna(row['下限 (%)']) else 0) / 100,
+            row['当前投入'] * row['上限 (%)'] / 100 if pd.notna(row['上限 (%)']) else np.inf
+        )
+        for _, row in edited.iterrows()
+        if pd.notna(row['下限 (%)']) or pd.notna(row['上限 (%)'])
+    }
+
+    allocation, error = compute_budget_allocation(marginal, total_budget, bound_column, bounds, max_multiple)
+    if error:
+        st.warning(error)
+        return
+
+    metric_cols = st.columns(3)
+    metric_cols[0].metric("当前投入", f"￥{current_total:,.0f}")
+    metric_cols[1].metric("建议投入", f"￥{allocation['建议投入'].sum():,.0f}",
+                          f"{allocation['建议投入'].sum() - current_total:+,.0f}")
+    metric_cols[2].metric("预计销售额变化", f"￥{allocation['预计销售额变化'].sum():+,.0f}")
+
+    group_label = '所属区域' if bound_by == "按区域" else '物料名称'
+    by_group = allocation.groupby(group_label)[['当前投入', '建议投入']].sum().reset_index() \
+        .sort_values('当前投入', ascending=False).head(20)
+    fig = go.Figure([
+        go.Bar(x=by_group[group_label], y=by_group['当前投入'], name='当前投入', marker_color='#aec7e8'),
+        go.Bar(x=by_group[group_label], y=by_group['建议投入'], name='建议投入', marker_color='#1f77b4')
+    ])
+    fig.update_layout(
+        title_text=f"当前投入与建议投入对比（{bound_by}）", barmode='group',
+        xaxis=dict(tickangle=-45), yaxis_title="物料投入 (元)", height=450
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    st.dataframe(
+        allocation.reindex(allocation['投入变化'].abs().sort_values(ascending=False).index).style.format({
+            '当前投入': '￥{:,.0f}',
+            '建议投入': '￥{:,.0f}',
+            '投入变化': '{:+,.0f}',
+            '边际销售额': '{:,.2f}',
+            '预计销售额变化': '{:+,.0f}'
+        }, na_rep='-'),
+        use_container_width=True, hide_index=True
+    )
+
+    st.markdown("""
+    **图表解读：**
+    - 建议投入按物料×区域的边际回报曲线求得：预算优先投向边际销售额高的组合，直到其边际销售额降到与其他组合相当或达到上限。
+    - 样本不足、无法拟合响应曲线的组合保持当前投入不变。
+    - 预计销售额变化基于历史客户-月份样本的拟合结果外推，投入大幅偏离历史水平时可靠性下降，建议结合置信区间谨慎采用。
+    """)
+
+
+# 物料效益分析
+def material_analysis(filtered_material, filtered_sales, filter_key=None):
+    """物料效益分析"""
+    st.markdown("## 物料效益分析")
+
+    material_roi = analysis_result(
+        filter_key, 'material_roi', lambda: compute_material_roi(filtered_material, filtered_sales)
+    )
+    material_roi_ci = analysis_result(
+        filter_key, 'material_roi_ci', lambda: compute_material_roi_ci(filtered_material, filtered_sales)
+    )
+    export_buttons("物料ROI", material_roi, filter_key)
+    with st.expander(f"浏览全部 {len(material_roi):,} 个物料"):
+        paginated_table("物料ROI", material_roi, filter_key, search_columns=('物料代码', '物料名称'),
+                        default_sort='ROI', formats={
+                            '物料总成本': '￥{:,.2f}',
+                            '销售总额': '￥{:,.2f}',
+                            'ROI': '{:,.2f}'
+                        })
+
     cols = st.columns(2)
 
     with cols[0]:
         if not material_roi.empty:
+            rank_by_lower = st.checkbox("按ROI置信下限排序", value=False,
+                                        help="按95%置信区间下限排名，使用次数少的物料不会因偶然的高值排在前面")
+
             # 物料ROI排名
-            top_materials = material_roi.dropna(subset=['ROI']).nlargest(10, 'ROI')
+            ranked = pd.merge(material_roi.dropna(subset=['ROI']), material_roi_ci, on=['物料代码', '物料名称'], how='left')
+            top_materials = ranked.nlargest(10, 'ROI下限' if rank_by_lower else 'ROI')
+            top_materials = top_materials.assign(
+                误差上=top_materials['ROI上限'] - top_materials['ROI'],
+                误差下=top_materials['ROI'] - top_materials['ROI下限']
+            )
 
             fig = px.bar(
                 top_materials,
@@ -1262,7 +3911,10 @@ def material_analysis(filtered_material, filtered_sales):
                 title="物料ROI TOP10",
                 color='ROI',
                 color_continuous_scale='Blues',
-                text='ROI'
+                text='ROI',
+                error_y='误差上',
+                error_y_minus='误差下',
+                hover_data=['观测数', 'ROI下限', 'ROI上限']
             )
 
             fig.update_traces(
@@ -1285,6 +3937,7 @@ def material_analysis(filtered_material, filtered_sales):
             - ROI表示投入物料成本所产生的回报率，计算公式为(销售额-物料成本)/物料成本。
             - ROI越高表示物料的销售转化效果越好，投资回报越高。
             - TOP10中的物料是最具投资价值的物料类型，应优先考虑增加投放。
+            - 误差线为自助法估计的95%置信区间，使用次数少的物料区间较宽，按置信下限排序可优先看到稳定的高回报物料。
             - ROI低于0的物料意味着投入大于产出，需要审视其投放策略或调整目标客户。
             - 建议将高ROI物料作为重点推广品类，提高整体营销效率。
             """)
@@ -1389,8 +4042,225 @@ def material_analysis(filtered_material, filtered_sales):
             """)
 
 
+# 关联物料与产品销售
+def compute_material_product(filtered_material, filtered_sales, lag_effect=False, engine=None):
+    """按(发运月份, 客户代码, 经销商名称)关联物料与产品销售，返回(关联明细, 是否使用了宽松匹配)"""
+    if resolve_engine(engine) == "polars":
+        return _material_product_polars(filtered_material, filtered_sales, lag_effect)
+
+    material_source = filtered_material
+    if lag_effect:
+        # 如果考虑滞后效应，需要将物料数据的月份加一个月
+        material_source = filtered_material.copy()
+        material_source['发运月份'] = material_source['发运月份'] + pd.DateOffset(months=1)
+
+    material_product = pd.merge(
+        material_source[['发运月份', '客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']],
+        filtered_sales[['发运月份', '客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']],
+        on=['发运月份', '客户代码', '经销商名称'],
+        how='inner'
+    )
+
+    loose_match = material_product.empty
+    if loose_match:
+        # 只按客户代码和经销商名称匹配，不考虑发运月份
+        material_product = pd.merge(
+            material_source[['客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']],
+            filtered_sales[['客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']],
+            on=['客户代码', '经销商名称'],
+            how='inner'
+        )
+
+    return material_product, loose_match
+
+
+# 计算衰减结转投入
+def compute_adstock(filtered_material, filtered_sales, decay_rates):
+    """衰减结转（Adstock）归因：每个客户每个物料类别的月度物料投入按几何级数结转到之后的月份，
+    A[t] = (1 - λ) * S[t] + λ * A[t-1]，λ为该类别每月的留存比例（decay_rates: {物料类别: λ}）。
+    全部 (客户, 类别) 序列排成矩阵后，每个类别调用一次scipy.signal.lfilter按月份方向同时滤波所有客户。
+    各客户当月的销售额按各类别衰减后投入的占比分摊，用于计算类别的ROI。
+    返回 (月度汇总, 类别汇总, 客户汇总)"""
+    material = filtered_material[~filtered_material['发运月份'].isna() & filtered_material['客户代码'].notna()]
+    sales = filtered_sales[~filtered_sales['发运月份'].isna() & filtered_sales['客户代码'].notna()]
+    if material.empty:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+    material_months = material['发运月份'].to_numpy(dtype='datetime64[M]')
+    sales_months = sales['发运月份'].to_numpy(dtype='datetime64[M]')
+    first_month = min(material_months.min(), sales_months.min(initial=material_months.min()))
+    last_month = max(material_months.max(), sales_months.max(initial=material_months.max()))
+    n_months = int((last_month - first_month).astype(int)) + 1
+
+    customer_codes, customers = pd.factorize(
+        np.concatenate([material['客户代码'].to_numpy(), sales['客户代码'].to_numpy()])
+    )
+    material_customer = customer_codes[:len(material)]
+    sales_customer = customer_codes[len(material):]
+    category_codes, categories = pd.factorize(material['物料类别'].to_numpy())
+    n_customers, n_categories = len(customers), len(categories)
+
+    # 投入矩阵 [类别, 客户, 月份] 与销售矩阵 [客户, 月份]
+    spend = np.bincount(
+        (category_codes * n_customers + material_customer) * n_months + (material_months - first_month).astype(int),
+        weights=np.nan_to_num(material['物料总成本'].to_numpy(dtype=float)),
+        minlength=n_categories * n_customers * n_months
+    ).reshape(n_categories, n_customers, n_months)
+    sales_matrix = np.bincount(
+        sales_customer * n_months + (sales_months - first_month).astype(int),
+        weights=np.nan_to_num(sales['销售总额'].to_numpy(dtype=float)),
+        minlength=n_customers * n_months
+    ).reshape(n_customers, n_months)
+
+    decayed = np.empty_like(spend)
+    rates = np.empty(n_categories)
+    for i, category in enumerate(categories):
+        rates[i] = decay_rates.get(category, ADSTOCK_DEFAULT_DECAY)
+        decayed[i] = scipy_signal.lfilter([1 - rates[i]], [1, -rates[i]], spend[i], axis=1)
+
+    # 按衰减后投入的占比把客户当月销售额分摊到各类别
+    total_decayed = decayed.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        attributed_sales = np.where(total_decayed > 0, decayed / total_decayed, 0) * sales_matrix
+
+    def roi(revenue, cost):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(cost > 0, (revenue - cost) / cost, np.nan)
+
+    months = pd.date_range(pd.Timestamp(first_month), periods=n_months, freq='MS')
+    monthly = pd.DataFrame({
+        '月份': months.strftime('%Y-%m'),
+        '物料总成本': spend.sum(axis=(0, 1)),
+        '衰减后投入': decayed.sum(axis=(0, 1)),
+        '销售总额': sales_matrix.sum(axis=0)
+    })
+
+    category_spend = spend.sum(axis=(1, 2))
+    category_decayed = decayed.sum(axis=(1, 2))
+    category_sales = attributed_sales.sum(axis=(1, 2))
+    by_category = pd.DataFrame({
+        '物料类别': categories,
+        '月留存比例': rates,
+        '物料总成本': category_spend,
+        '衰减后投入': category_decayed,
+        '归因销售额': category_sales,
+        'ROI': roi(category_sales, category_spend),
+        '衰减后ROI': roi(category_sales, category_decayed)
+    })
+
+    customer_spend = spend.sum(axis=(0, 2))
+    customer_decayed = decayed.sum(axis=(0, 2))
+    customer_sales = sales_matrix.sum(axis=1)
+    names = material.drop_duplicates('客户代码').set_index('客户代码')['经销商名称']
+    by_customer = pd.DataFrame({
+        '客户代码': customers,
+        '经销商名称': names.reindex(customers).to_numpy(),
+        '物料总成本': customer_spend,
+        '衰减后投入': customer_decayed,
+        '销售总额': customer_sales,
+        'ROI': roi(customer_sales, customer_spend),
+        '衰减后ROI': roi(customer_sales, customer_decayed)
+    })
+    by_customer = by_customer[by_customer['物料总成本'] > 0].reset_index(drop=True)
+    return monthly, by_category, by_customer
+
+
+# 默认月留存比例
+def default_decay_rates(filtered_material):
+    """返回数据中各物料类别的默认月留存比例 {物料类别: 留存比例}，即衰减结转分析中滑块的初始值"""
+    return {
+        category: float(ADSTOCK_DECAY.get(category, ADSTOCK_DEFAULT_DECAY))
+        for category in sorted(filtered_material['物料类别'].dropna().unique())
+    }
+
+
+# 衰减结转归因分析
+def adstock_analysis(filtered_material, filtered_sales, filter_key=None):
+    """衰减结转（Adstock）归因分析"""
+    st.markdown("### 衰减结转归因（Adstock）")
+    st.caption("物料投入的效果按月留存比例逐月衰减并结转到之后的月份，ROI按衰减后落在所选日期范围内的投入计算")
+
+    defaults = default_decay_rates(filtered_material)
+    if not defaults:
+        st.warning("没有足够的数据来进行衰减结转归因")
+        return
+
+    cols = st.columns(len(defaults))
+    decay_rates = {}
+    for col, (category, default) in zip(cols, defaults.items()):
+        with col:
+            decay_rates[category] = st.slider(f"{category}月留存比例:", 0.0, 0.95, default, 0.05)
+
+    monthly, by_category, by_customer = analysis_result(
+        filter_key, ('adstock', tuple(sorted(decay_rates.items()))),
+        lambda: compute_adstock(filtered_material, filtered_sales, decay_rates)
+    )
+    if monthly.empty:
+        st.warning("没有足够的数据来进行衰减结转归因")
+        return
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=monthly['月份'], y=monthly['物料总成本'], name='当月物料投入', marker_color='#ff7f0e'))
+    fig.add_trace(go.Scatter(x=monthly['月份'], y=monthly['衰减后投入'], name='衰减后投入',
+                             mode='lines+markers', line=dict(color='#d62728', width=3)))
+    fig.update_layout(
+        title_text="当月物料投入与衰减后投入",
+        xaxis_title="月份",
+        yaxis=dict(title="物料投入 (元)", tickprefix="￥", tickformat=",.2f"),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        height=400
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    money = '￥{:,.2f}'
+    st.dataframe(by_category.style.format({
+        '月留存比例': '{:.2f}',
+        '物料总成本': money,
+        '衰减后投入': money,
+        '归因销售额': money,
+        'ROI': '{:.2f}',
+        '衰减后ROI': '{:.2f}'
+    }, na_rep='-'), use_container_width=True, hide_index=True)
+
+    st.markdown("#### 客户衰减后ROI TOP10")
+    st.dataframe(by_customer.nlargest(10, '衰减后ROI').style.format({
+        '物料总成本': money,
+        '衰减后投入': money,
+        '销售总额': money,
+        'ROI': '{:.2f}',
+        '衰减后ROI': '{:.2f}'
+    }, na_rep='-'), use_container_width=True, hide_index=True)
+
+    st.markdown("""
+    **图表解读：**
+    - 衰减后投入把每月的物料投入按留存比例分摊到当月和之后的月份，留存比例越高，物料效果持续越久。
+    - 类别的归因销售额按各客户每月衰减后投入中该类别的占比分摊销售额。
+    - 与按当月投入计算的ROI相比，衰减后ROI更能反映陈列类等长期物料的真实回报。
+    """)
+
+
+# 汇总物料-产品关联
+def aggregate_material_product(material_product, engine=None):
+    """按物料和产品汇总关联明细，并计算投入产出比"""
+    if resolve_engine(engine) == "polars":
+        return _material_product_agg_polars(material_product)
+
+    material_product_agg = material_product.groupby(['物料名称', '产品名称']).agg({
+        '物料数量': 'sum',
+        '物料总成本': 'sum',
+        '销售总额': 'sum'
+    }).reset_index()
+
+    # 计算投入产出比
+    material_product_agg['投入产出比'] = material_product_agg['销售总额'] / material_product_agg['物料总成本'].where(
+        material_product_agg['物料总成本'] > 0, np.nan
+    )
+
+    return material_product_agg
+
+
 # 物料-产品关联分析
-def material_product_analysis(filtered_material, filtered_sales):
+def material_product_analysis(filtered_material, filtered_sales, filter_key=None, distinct=None):
     """物料-产品关联分析"""
     st.markdown("## 物料-产品关联分析")
 
@@ -1402,47 +4272,16 @@ def material_product_analysis(filtered_material, filtered_sales):
                              help="启用后，将分析物料投放后下一个月的销售效果，以考虑物料效果的滞后性")
 
     # 合并物料和销售数据，使用更灵活的匹配逻辑
-    if lag_effect:
-        # 如果考虑滞后效应，需要将物料数据的月份加一个月
-        filtered_material_lag = filtered_material.copy()
-        filtered_material_lag['发运月份'] = filtered_material_lag['发运月份'] + pd.DateOffset(months=1)
-
-        # 使用滞后调整后的物料数据进行关联
-        material_product = pd.merge(
-            filtered_material_lag[
-                ['发运月份', '客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']],
-            filtered_sales[['发运月份', '客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']],
-            on=['发运月份', '客户代码', '经销商名称'],
-            how='inner'
-        )
+    material_product, loose_match = analysis_result(
+        filter_key, ('material_product', lag_effect),
+        lambda: compute_material_product(filtered_material, filtered_sales, lag_effect)
+    )
 
-        if material_product.empty:
+    if loose_match:
+        if lag_effect:
             st.warning("考虑滞后效应后未找到匹配数据，尝试更宽松的匹配...")
-            # 只按客户代码和经销商名称匹配，不考虑发运月份
-            material_product = pd.merge(
-                filtered_material_lag[['客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']],
-                filtered_sales[['客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']],
-                on=['客户代码', '经销商名称'],
-                how='inner'
-            )
-    else:
-        # 原始匹配逻辑
-        material_product = pd.merge(
-            filtered_material[['发运月份', '客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']],
-            filtered_sales[['发运月份', '客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']],
-            on=['发运月份', '客户代码', '经销商名称'],
-            how='inner'
-        )
-
-        if material_product.empty:
+        else:
             st.warning("使用精确匹配未找到物料-产品关联数据，尝试更宽松的匹配...")
-            # 只按客户代码和经销商名称匹配，不考虑发运月份
-            material_product = pd.merge(
-                filtered_material[['客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']],
-                filtered_sales[['客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']],
-                on=['客户代码', '经销商名称'],
-                how='inner'
-            )
 
     if material_product.empty:
         st.warning("没有匹配的物料-产品数据来进行关联分析")
@@ -1467,40 +4306,22 @@ def material_product_analysis(filtered_material, filtered_sales):
             st.success(f"找到包含 '{search_term}' 的物料: {', '.join(matched_materials)}")
 
             # 提取这些物料的数据统计
+            customer_counts = None
+            if distinct is not None:
+                customer_counts = distinct.count('物料名称', '客户代码').set_index('物料名称')['去重数']
             for material in matched_materials:
                 material_data = filtered_material[filtered_material['物料名称'] == material]
+                customers = customer_counts.get(material, 0) if customer_counts is not None \
+                    else material_data['客户代码'].nunique()
                 st.markdown(f"""
                 **{material} 数据统计:**
                 - 总发放数量: {material_data['物料数量'].sum():,.0f}
                 - 总物料成本: ￥{material_data['物料总成本'].sum():,.2f}
-                - 使用客户数: {material_data['客户代码'].nunique()}
+                - 使用客户数: {customers}
                 """)
         else:
             st.warning(f"未找到包含 '{search_term}' 的物料")
 
-    # 合并物料和销售数据，使用更灵活的匹配逻辑
-    material_product = pd.merge(
-        filtered_material[['发运月份', '客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']],
-        filtered_sales[['发运月份', '客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']],
-        on=['发运月份', '客户代码', '经销商名称'],
-        how='inner'
-    )
-
-    # 如果没有匹配数据，尝试使用更宽松的连接
-    if material_product.empty:
-        st.warning("使用精确匹配未找到物料-产品关联数据，尝试更宽松的匹配...")
-        # 只按客户代码和经销商名称匹配，不考虑发运月份
-        material_product = pd.merge(
-            filtered_material[['客户代码', '经销商名称', '物料代码', '物料名称', '物料数量', '物料总成本']],
-            filtered_sales[['客户代码', '经销商名称', '产品代码', '产品名称', '销售总额']],
-            on=['客户代码', '经销商名称'],
-            how='inner'
-        )
-
-    if material_product.empty:
-        st.warning("没有匹配的物料-产品数据来进行关联分析")
-        return
-
     # 如果有搜索词并找到了匹配物料，尝试找到该物料的产品关联
     if search_term and matched_materials:
         for material in matched_materials:
@@ -1539,16 +4360,10 @@ def material_product_analysis(filtered_material, filtered_sales):
                 st.info(f"未找到 {material} 与任何产品的直接关联")
 
     # 按物料和产品分组
-    material_product_agg = material_product.groupby(['物料名称', '产品名称']).agg({
-        '物料数量': 'sum',
-        '物料总成本': 'sum',
-        '销售总额': 'sum'
-    }).reset_index()
-
-    # 计算投入产出比
-    material_product_agg['投入产出比'] = material_product_agg['销售总额'] / material_product_agg['物料总成本'].where(
-        material_product_agg['物料总成本'] > 0, np.nan
+    material_product_agg = analysis_result(
+        filter_key, ('material_product_agg', lag_effect), lambda: aggregate_material_product(material_product)
     )
+    export_buttons("物料产品汇总", material_product_agg, (filter_key or (None,)) + (('material_product_agg', lag_effect),))
 
     cols = st.columns(2)
 
@@ -1739,6 +4554,16 @@ def material_product_analysis(filtered_material, filtered_sales):
         # 添加物料数量统计
         material_combinations['物料数量'] = material_combinations['物料名称'].apply(lambda x: len(x.split(', ')))
 
+        # 平均投入产出比的95%置信区间（所有单物料和组合一次重抽样）
+        rank_by_lower = st.checkbox("按投入产出比置信下限排序", value=False,
+                                    help="按95%置信区间下限排名，使用次数少的组合不会因偶然的高值排在前面")
+        rated = material_combinations.dropna(subset=['投入产出比'])
+        combination_ci = analysis_result(
+            filter_key, ('combination_ci', lag_effect),
+            lambda: bootstrap_ratio_ci(rated['物料名称'], rated['投入产出比'], np.ones(len(rated)))
+        )
+        sort_column = '投入产出比下限' if rank_by_lower else '平均投入产出比'
+
         # 单物料与组合分开分析
         single_materials = material_combinations[material_combinations['物料数量'] == 1].copy()
         multi_materials = material_combinations[material_combinations['物料数量'] > 1].copy()
@@ -1758,11 +4583,14 @@ def material_product_analysis(filtered_material, filtered_sales):
             single_analysis.columns = ['物料名称', '使用次数', '物料总成本', '销售总额', '平均投入产出比']
 
             # 筛选使用次数>=2的物料
-            frequent_singles = single_analysis[single_analysis['使用次数'] >= 2]
+            frequent_singles = single_analysis[single_analysis['使用次数'] >= 2].assign(
+                投入产出比下限=lambda df: df['物料名称'].map(combination_ci['下限']),
+                投入产出比上限=lambda df: df['物料名称'].map(combination_ci['上限'])
+            )
 
             if not frequent_singles.empty:
                 # 创建单物料效率条形图
-                top_singles = frequent_singles.nlargest(10, '平均投入产出比')
+                top_singles = frequent_singles.nlargest(10, sort_column)
 
                 fig = px.bar(
                     top_singles,
@@ -1772,7 +4600,9 @@ def material_product_analysis(filtered_material, filtered_sales):
                     color_continuous_scale='Viridis',
                     title="高效单物料TOP10",
                     orientation='h',
-                    hover_data=['物料总成本', '销售总额']
+                    error_x=top_singles['投入产出比上限'] - top_singles['平均投入产出比'],
+                    error_x_minus=top_singles['平均投入产出比'] - top_singles['投入产出比下限'],
+                    hover_data=['物料总成本', '销售总额', '投入产出比下限', '投入产出比上限']
                 )
 
                 fig.update_layout(
@@ -1812,11 +4642,14 @@ def material_product_analysis(filtered_material, filtered_sales):
             combo_analysis.columns = ['物料组合', '使用次数', '物料总成本', '销售总额', '平均投入产出比']
 
             # 筛选出现次数>=2的组合
-            frequent_combos = combo_analysis[combo_analysis['使用次数'] >= 2]
+            frequent_combos = combo_analysis[combo_analysis['使用次数'] >= 2].assign(
+                投入产出比下限=lambda df: df['物料组合'].map(combination_ci['下限']),
+                投入产出比上限=lambda df: df['物料组合'].map(combination_ci['上限'])
+            )
 
             if not frequent_combos.empty:
                 # 创建组合效率条形图
-                top_combos = frequent_combos.nlargest(10, '平均投入产出比')
+                top_combos = frequent_combos.nlargest(10, sort_column)
 
                 fig = px.bar(
                     top_combos,
@@ -1826,7 +4659,9 @@ def material_product_analysis(filtered_material, filtered_sales):
                     color_continuous_scale='Viridis',
                     title="高效物料组合TOP10",
                     orientation='h',
-                    hover_data=['物料总成本', '销售总额']
+                    error_x=top_combos['投入产出比上限'] - top_combos['平均投入产出比'],
+                    error_x_minus=top_combos['平均投入产出比'] - top_combos['投入产出比下限'],
+                    hover_data=['物料总成本', '销售总额', '投入产出比下限', '投入产出比上限']
                 )
 
                 fig.update_layout(
@@ -1914,54 +4749,401 @@ def material_product_analysis(filtered_material, filtered_sales):
         st.warning("没有足够的数据来进行物料组合分析")
 
 
-def create_sidebar_filters(df_material):
-    """创建侧边栏过滤器"""
+# 数据质量
+def data_quality_analysis(snapshot, partition_names):
+    """显示所选分区在数据加载时生成的数据质量报告"""
+    st.markdown("## 数据质量")
+    st.caption("报告在数据加载时生成并按数据版本缓存，示例列出问题值，无法定位到具体值时列出Excel行号")
+
+    for name in partition_names:
+        report = snapshot.quality_report(name)
+        st.markdown(f"### 分区 {name}")
+        if report is None:
+            st.error("该分区数据加载失败")
+        elif report.empty:
+            st.success("未发现数据质量问题")
+        else:
+            report = report.assign(占比=report['问题行数'] / report['总行数'] * 100)
+            st.dataframe(report.style.format({'占比': '{:.2f}%'}), use_container_width=True, hide_index=True)
+
+
+# 时期对比的维度：{名称: 分组列}
+COMPARISON_DIMENSIONS = {
+    '整体': [],
+    '区域': ['所属区域'],
+    '省份': ['省份'],
+    '申请人': ['申请人'],
+    '客户': ['客户代码', '经销商名称'],
+    '物料': ['物料代码', '物料名称']
+}
+
+
+# 计算时期对比
+def compute_period_comparison(df_material, df_sales, regions, provinces, periods):
+    """periods为 [(时期名, 开始日期, 结束日期), ...]。把各时期筛选出的行号连同时期标签拼接起来，
+    每个维度只做一次按 维度 + 时期 的分组汇总，而不是对每个时期分别运行整套分析。
+    返回与COMPARISON_DIMENSIONS顺序一致的对比表元组，每个指标按时期展开为列，并附带变化"""
+    labels = [label for label, _, _ in periods]
+
+    def stack(df, columns):
+        indexes = [filter_index(df, regions, provinces, start, end) for _, start, end in periods]
+        rows = df[columns].take(np.concatenate(indexes))
+        # 两个时期可以重叠，重叠的行在两个时期各计一次
+        rows['时期'] = pd.Categorical(np.repeat(labels, [len(index) for index in indexes]), categories=labels)
+        return rows
+
+    material_columns = list(dict.fromkeys(col for cols in COMPARISON_DIMENSIONS.values() for col in cols))
+    material = stack(df_material, material_columns + ['物料总成本', '物料数量'])
+    sales = stack(df_sales, [col for col in material_columns if col in df_sales.columns] + ['销售总额'])
+
+    tables = []
+    for dimension, columns in COMPARISON_DIMENSIONS.items():
+        keys = columns + ['时期']
+        table = material.groupby(keys, observed=True)[['物料总成本', '物料数量']].sum()
+        if all(col in sales.columns for col in columns):
+            table = table.join(sales.groupby(keys, observed=True)[['销售总额']].sum(), how='outer')
+        table = table.fillna(0)
+        # 各时期展开为列（某时期没有数据时补0）；整体只有时期一个分组键，展开后为一行
+        if columns:
+            table = table.unstack('时期', fill_value=0).reindex(
+                columns=pd.MultiIndex.from_product([table.columns, labels]), fill_value=0
+            )
+        else:
+            table = table.reindex(labels, fill_value=0).unstack().to_frame().T
+        table.columns = [f'{metric}_{label}' for metric, label in table.columns]
+
+        current, previous = labels
+        metrics = ['物料总成本', '物料数量'] + (['销售总额'] if f'销售总额_{current}' in table.columns else [])
+        if '销售总额' in metrics:
+            for label in labels:
+                sales_total = table[f'销售总额_{label}'].to_numpy(dtype=float)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    table[f'费比_{label}'] = np.where(
+                        sales_total > 0, table[f'物料总成本_{label}'].to_numpy(dtype=float) / sales_total * 100, np.nan
+                    )
+            table['费比变化'] = table[f'费比_{current}'] - table[f'费比_{previous}']
+        for metric in metrics:
+            base = table[f'{metric}_{previous}'].to_numpy(dtype=float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                table[f'{metric}变化%'] = np.where(
+                    base > 0, (table[f'{metric}_{current}'].to_numpy(dtype=float) / base - 1) * 100, np.nan
+                )
+        tables.append(table.reset_index(drop=not columns))
+    return tuple(tables)
+
+
+# 时期对比分析
+def period_comparison_analysis(comparison, start_date, end_date, compare_start, compare_end, filter_key=None):
+    """按所选维度显示本期与对比期的汇总及变化；filter_key为对比结果的缓存键，用于导出"""
+    st.markdown("## 时期对比")
+    st.caption(f"本期: {start_date} ~ {end_date}，对比期: {compare_start} ~ {compare_end}")
+
+    dimensions = list(COMPARISON_DIMENSIONS)
+    dimension = st.selectbox("对比维度:", dimensions[1:], index=0)
+    table = comparison[dimensions.index(dimension)]
+
+    sort_column = '销售总额_本期' if '销售总额_本期' in table.columns else '物料总成本_本期'
+    table = table.sort_values(sort_column, ascending=False)
+    export_buttons(
+        f"时期对比_{dimension}", table,
+        (filter_key or (None,)) + (('comparison', str(compare_start), str(compare_end)),)
+    )
+
+    formats = {}
+    for col in table.columns:
+        if col.endswith('变化%'):
+            formats[col] = '{:+.2f}%'
+        elif col.startswith(('物料总成本_', '销售总额_')):
+            formats[col] = '￥{:,.2f}'
+        elif col.startswith('费比_'):
+            formats[col] = '{:.2f}%'
+        elif col == '费比变化':
+            formats[col] = '{:+.2f}'
+    st.dataframe(table.style.format(formats, na_rep='-'), use_container_width=True, hide_index=True)
+
+
+# 异常检测
+def detect_anomalies(df_material, df_sales):
+    """对每个客户、申请人和省份的月度费比和物料效率计算稳健Z值：z = 0.6745 × (x - 中位数) / MAD。
+    每个维度先用np.bincount构造 [对象, 月份] 的成本、销售额、数量矩阵，再在整个矩阵上按行求中位数和MAD，
+    不逐个对象循环。只在有物料投入且有销售的月份计算费比、有物料数量的月份计算物料效率。
+    返回异常清单，按稳健Z值绝对值从大到小排序"""
+    material_months = df_material['发运月份'].to_numpy(dtype='datetime64[M]')
+    sales_months = df_sales['发运月份'].to_numpy(dtype='datetime64[M]')
+    valid_material, valid_sales = ~np.isnat(material_months), ~np.isnat(sales_months)
+    if not valid_material.any():
+        return pd.DataFrame()
+    first_month = min(material_months[valid_material].min(), sales_months[valid_sales].min(initial=material_months[valid_material].min()))
+    last_month = max(material_months[valid_material].max(), sales_months[valid_sales].max(initial=material_months[valid_material].max()))
+    n_months = int((last_month - first_month).astype(int)) + 1
+    month_labels = np.datetime_as_string(first_month + np.arange(n_months).astype('timedelta64[M]'), unit='M')
+
+    alerts = []
+    for dimension, column in ANOMALY_DIMENSIONS.items():
+        entity_codes, entities = pd.factorize(
+            np.concatenate([df_material[column].to_numpy(), df_sales[column].to_numpy()])
+        )
+        material_entity = entity_codes[:len(df_material)]
+        sales_entity = entity_codes[len(df_material):]
+        n_entities = len(entities)
+        keep_material = valid_material & (material_entity >= 0)
+        keep_sales = valid_sales & (sales_entity >= 0)
+
+        def matrix(entity, months, keep, values):
+            cells = entity[keep] * n_months + (months[keep] - first_month).astype(int)
+            return np.bincount(cells, weights=np.nan_to_num(values[keep]), minlength=n_entities * n_months) \
+                .reshape(n_entities, n_months)
+
+        cost = matrix(material_entity, material_months, keep_material, df_material['物料总成本'].to_numpy(dtype=float))
+        quantity = matrix(material_entity, material_months, keep_material, df_material['物料数量'].to_numpy(dtype=float))
+        sales = matrix(sales_entity, sales_months, keep_sales, df_sales['销售总额'].to_numpy(dtype=float))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = {
+                '费比': np.where((cost > 0) & (sales > 0), cost / sales * 100, np.nan),
+                '物料效率': np.where(quantity > 0, sales / quantity, np.nan)
+            }
+
+        for metric, values in metrics.items():
+            observed = (~np.isnan(values)).sum(axis=1)
+            enough = observed >= ANOMALY_MIN_MONTHS
+            if not enough.any():
+                continue
+            values = values[enough]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                median = np.nanmedian(values, axis=1)
+                mad = np.nanmedian(np.abs(values - median[:, None]), axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                z = 0.6745 * (values - median[:, None]) / mad[:, None]
+            flagged_row, flagged_month = np.nonzero(np.abs(np.nan_to_num(z)) > ANOMALY_Z_THRESHOLD)
+            if len(flagged_row) == 0:
+                continue
+
+            alert_entities = entities[np.flatnonzero(enough)[flagged_row]]
+            alerts.append(pd.DataFrame({
+                '维度': dimension,
+                '对象': alert_entities,
+                '月份': month_labels[flagged_month],
+                '指标': metric,
+                '数值': values[flagged_row, flagged_month],
+                '中位数': median[flagged_row],
+                '稳健Z值': z[flagged_row, flagged_month],
+                '有效月数': observed[enough][flagged_row]
+            }))
+
+    if not alerts:
+        return pd.DataFrame()
+    anomalies = pd.concat(alerts, ignore_index=True)
+    anomalies['方向'] = np.where(anomalies['稳健Z值'] > 0, '偏高', '偏低')
+
+    # 客户显示经销商名称；客户和省份附带所属区域、省份，便于按侧边栏筛选
+    customers = df_material.drop_duplicates('客户代码').set_index('客户代码')
+    provinces = df_material.drop_duplicates('省份').set_index('省份')
+    is_customer = (anomalies['维度'] == '客户').to_numpy()
+    is_province = (anomalies['维度'] == '省份').to_numpy()
+    anomalies['名称'] = np.where(is_customer, anomalies['对象'].map(customers['经销商名称']), anomalies['对象'])
+    anomalies['所属区域'] = np.where(
+        is_customer, anomalies['对象'].map(customers['所属区域']),
+        np.where(is_province, anomalies['对象'].map(provinces['所属区域']), None)
+    )
+    anomalies['省份'] = np.where(is_customer, anomalies['对象'].map(customers['省份']),
+                               np.where(is_province, anomalies['对象'], None))
+    order = np.argsort(-np.abs(anomalies['稳健Z值'].to_numpy()), kind='stable')
+    return anomalies.iloc[order].reset_index(drop=True)
+
+
+# 异常提醒
+def display_anomaly_alerts(anomalies, regions, provinces, start_date, end_date, customers=None):
+    """在KPI卡片下方列出所选日期范围内的异常月份；申请人异常不区分区域，始终显示。
+    指定customers（联动筛选的客户）时只显示这些客户的异常"""
+    if anomalies.empty:
+        return
+    mask = (anomalies['月份'] >= f"{start_date:%Y-%m}") & (anomalies['月份'] <= f"{end_date:%Y-%m}")
+    if regions:
+        mask &= anomalies['所属区域'].isna() | anomalies['所属区域'].isin(regions)
+    if provinces:
+        mask &= anomalies['省份'].isna() | anomalies['省份'].isin(provinces)
+    if customers:
+        mask &= (anomalies['维度'] == '客户') & anomalies['对象'].isin(customers)
+    alerts = anomalies[mask]
+    if alerts.empty:
+        return
+
+    with st.expander(f"异常提醒：{len(alerts)} 条（费比或物料效率明显偏离该对象自身的常态水平）"):
+        st.caption(f"稳健Z值绝对值超过 {ANOMALY_Z_THRESHOLD} 的月份，基于每个对象全部月份的中位数和中位数绝对偏差计算")
+        st.dataframe(
+            alerts[['维度', '名称', '月份', '指标', '方向', '数值', '中位数', '稳健Z值', '有效月数']].style.format({
+                '数值': '{:,.2f}',
+                '中位数': '{:,.2f}',
+                '稳健Z值': '{:+.2f}'
+            }),
+            use_container_width=True, hide_index=True
+        )
+
+
+# 显示数据版本
+def display_data_status(refresher, snapshot):
+    """在侧边栏显示当前数据快照的时间和后台刷新状态"""
+    if snapshot.source_time is not None:
+        st.sidebar.caption(f"数据截至: {snapshot.source_time:%Y-%m-%d %H:%M}（加载于 {snapshot.loaded_at:%H:%M:%S}）")
+    if refresher.refreshing:
+        st.sidebar.info("检测到数据源更新，正在后台刷新，当前仍显示旧数据")
+    elif refresher.last_error:
+        st.sidebar.warning(f"后台刷新数据失败，继续显示旧数据: {refresher.last_error}")
+
+
+# 显示缓存统计
+def display_cache_stats():
+    """在侧边栏显示进程内分析结果缓存的占用和命中情况（在各分析渲染完成后调用）"""
+    entries, nbytes, hits, misses = get_result_memo().stats()
+    st.sidebar.caption(f"分析缓存: {entries} 项 / {nbytes / 1024 / 1024:.1f} MB，命中 {hits} 次，未命中 {misses} 次")
+
+
+# 分析计算步骤
+def analysis_steps(filtered_material, filtered_sales):
+    """返回 {分析名: 计算函数}，名称与各分析函数中analysis_result使用的名称一致；
+    带选项的分析只包含页面默认选项对应的名称（预算优化使用按物料×区域拟合的边际回报）"""
+    steps = {
+        'region': lambda: compute_region_metrics(filtered_material, filtered_sales),
+        'applicant': lambda: compute_applicant_data(filtered_material, filtered_sales),
+        'applicant_ci': lambda: compute_applicant_ci(filtered_material, filtered_sales),
+        'monthly': lambda: compute_monthly_data(filtered_material, filtered_sales),
+        'customer': lambda: compute_customer_value(filtered_material, filtered_sales),
+        'material_roi': lambda: compute_material_roi(filtered_material, filtered_sales),
+        'material_roi_ci': lambda: compute_material_roi_ci(filtered_material, filtered_sales),
+        ('material_recommendation', '物料数量'): (
+            lambda: compute_material_recommendations(filtered_material, filtered_sales, '物料数量')
+        ),
+    }
+    for lag_effect in (False, True):
+        steps[('material_product', lag_effect)] = (
+            lambda lag_effect=lag_effect: compute_material_product(filtered_material, filtered_sales, lag_effect)
+        )
+    for by_region in (False, True):
+        steps[('marginal_roi', by_region)] = (
+            lambda by_region=by_region: compute_marginal_roi(filtered_material, filtered_sales, by_region)
+        )
+    decay_rates = default_decay_rates(filtered_material)
+    if decay_rates:
+        steps[('adstock', tuple(sorted(decay_rates.items())))] = (
+            lambda: compute_adstock(filtered_material, filtered_sales, decay_rates)
+        )
+    return steps
+
+
+# 预热默认视图
+def warm_up(snapshot):
+    """对默认视图（最新分区）预先计算全部分析（包括物料-产品关联的明细与汇总），返回 {(筛选键, 分析名): 结果}"""
+    partition_names = default_partitions(snapshot.registry)
+    df_material, df_sales, _ = snapshot.frames(partition_names)
+    if df_material is None:
+        return {}
+
+    filters = default_filters(snapshot.registry)
+    filter_key = make_filter_key(snapshot.dataset_version(partition_names), *filters)
+    filtered_material = filter_data(df_material, *filters)
+    filtered_sales = filter_data(df_sales, *filters)
+    if filtered_material.empty or filtered_sales.empty:
+        return {}
+
+    # 优先从磁盘结果缓存读取，服务重启后预热几乎不需要重新计算
+    results = {}
+    try:
+        # 异常检测只依赖所选分区的数据版本，不随筛选条件变化
+        version_key = make_filter_key(snapshot.dataset_version(partition_names))
+        results[(version_key, 'anomalies')] = cached_compute(
+            version_key, 'anomalies', lambda: detect_anomalies(df_material, df_sales)
+        )
+        for name, compute in analysis_steps(filtered_material, filtered_sales).items():
+            results[(filter_key, name)] = cached_compute(filter_key, name, compute)
+            if isinstance(name, tuple) and name[0] == 'material_product':
+                agg_name = ('material_product_agg', name[1])
+                material_product = results[(filter_key, name)][0]
+                results[(filter_key, agg_name)] = cached_compute(
+                    filter_key, agg_name, lambda: aggregate_material_product(material_product)
+                )
+    except Exception:
+        # 预热失败不影响数据加载，相应分析在访问时再计算
+        pass
+    return results
+
+
+def create_sidebar_filters(snapshot):
+    """创建侧边栏过滤器。日期范围决定需要加载的分区，因此先处理日期，再用所选分区的数据生成区域和省份选项；
+    返回 (区域, 省份, 开始日期, 结束日期, 分区名)"""
     st.sidebar.header("数据筛选")
+    region_box = st.sidebar.container()
+    province_box = st.sidebar.container()
+    date_box = st.sidebar.container()
+
+    # 日期范围筛选器，可选范围覆盖注册表中的全部分区，默认为最新分区
+    partitions = snapshot.registry['partitions']
+    min_date = min(partition['start'] for partition in partitions)
+    max_date = max(partition['end'] for partition in partitions)
+    _, _, default_start, default_end = default_filters(snapshot.registry)
+
+    date_range = date_box.date_input(
+        "选择日期范围:",
+        value=(default_start, default_end),
+        min_value=min_date,
+        max_value=max_date
+    )
 
-    # 获取所有区域和省份
-    regions = sorted(df_material['所属区域'].dropna().unique())
-    provinces = sorted(df_material['省份'].dropna().unique())
+    # 处理日期选择结果
+    if len(date_range) == 2:
+        start_date, end_date = date_range
+    else:
+        start_date = default_start
+        end_date = default_end
+
+    partition_names = select_partitions(snapshot.registry, start_date, end_date)
+    df_material = snapshot.frames(partition_names)[0] if partition_names else None
+
+    # 获取所选分区的所有区域和省份
+    if df_material is not None:
+        regions = sorted(df_material['所属区域'].dropna().unique())
+        provinces = sorted(df_material['省份'].dropna().unique())
+    else:
+        regions, provinces = [], []
 
     # 区域筛选器
-    selected_regions = st.sidebar.multiselect(
+    selected_regions = region_box.multiselect(
         "选择区域:",
         options=regions,
         default=[]
     )
 
     # 省份筛选器
-    selected_provinces = st.sidebar.multiselect(
+    selected_provinces = province_box.multiselect(
         "选择省份:",
         options=provinces,
         default=[]
     )
 
-    # 日期范围筛选器
-    try:
-        # 确保日期列为datetime类型
-        if '发运月份' in df_material.columns:
-            min_date = df_material['发运月份'].min().date()
-            max_date = df_material['发运月份'].max().date()
-        else:
-            min_date = datetime.now().date() - timedelta(days=365)
-            max_date = datetime.now().date()
-    except:
-        min_date = datetime.now().date() - timedelta(days=365)
-        max_date = datetime.now().date()
+    return selected_regions, selected_provinces, start_date, end_date, partition_names
 
-    date_range = st.sidebar.date_input(
-        "选择日期范围:",
-        value=(min_date, max_date)
-    )
 
-    # 处理日期选择结果
-    if len(date_range) == 2:
-        start_date, end_date = date_range
-    else:
-        start_date = min_date
-        end_date = max_date
+def create_comparison_filters(snapshot, start_date, end_date):
+    """对比模式：勾选后选择对比期的日期范围（默认为上一年同期），返回 (开始日期, 结束日期)，未开启时返回None"""
+    if not st.sidebar.checkbox("对比模式", value=False):
+        return None
+
+    partitions = snapshot.registry['partitions']
+    min_date = min(partition['start'] for partition in partitions)
+    max_date = max(partition['end'] for partition in partitions)
+    default_start = min(max((pd.Timestamp(start_date) - pd.DateOffset(years=1)).date(), min_date), max_date)
+    default_end = min(max((pd.Timestamp(end_date) - pd.DateOffset(years=1)).date(), default_start), max_date)
 
-    return selected_regions, selected_provinces, start_date, end_date
+    compare_range = st.sidebar.date_input(
+        "对比期日期范围:",
+        value=(default_start, default_end),
+        min_value=min_date,
+        max_value=max_date
+    )
+    if len(compare_range) == 2:
+        return tuple(compare_range)
+    return default_start, default_end
 
 
 # 主函数
@@ -1980,18 +5162,70 @@ def main():
     # 密码正确，继续执行原有代码
     # 加载数据
     with st.spinner("正在加载数据，请稍候..."):
-        df_material, df_sales, df_material_price = load_data()
+        refresher = get_data_refresher()
+        snapshot = refresher.snapshot()
+        if snapshot is None:
+            st.stop()
 
-    # 加载数据
+    # 创建侧边栏过滤器
+    selected_regions, selected_provinces, start_date, end_date, partition_names = create_sidebar_filters(snapshot)
+    compare_range = create_comparison_filters(snapshot, start_date, end_date)
+
+    # 显示数据版本
+    display_data_status(refresher, snapshot)
+
+    # 加载所选日期范围涉及的分区
     with st.spinner("正在加载数据，请稍候..."):
-        df_material, df_sales, df_material_price = load_data()
+        df_material, df_sales, df_material_price = snapshot.frames(partition_names)
+    if not partition_names or df_material is None:
+        st.warning("当前筛选条件下没有数据。请尝试更改筛选条件。")
+        return
 
-    # 创建侧边栏过滤器
-    selected_regions, selected_provinces, start_date, end_date = create_sidebar_filters(df_material)
+    # 提示发运月份没有生效单价的物料，这些物料的成本不计入统计
+    unmatched_codes = unmatched_price_codes(df_material)
+    if unmatched_codes:
+        with st.sidebar.expander(f"{len(unmatched_codes)} 个物料代码缺少单价"):
+            st.write("、".join(map(str, unmatched_codes)))
 
     # 应用过滤器
     filtered_material = filter_data(df_material, selected_regions, selected_provinces, start_date, end_date)
     filtered_sales = filter_data(df_sales, selected_regions, selected_provinces, start_date, end_date)
+    filter_key = make_filter_key(
+        snapshot.dataset_version(partition_names), selected_regions, selected_provinces, start_date, end_date
+    )
+
+    # 图表联动筛选：在侧边栏筛选结果上按缓存的行号索引求交集，不重新执行filter_data
+    cross_filters = display_cross_filters(filtered_material)
+    base_material, base_sales, base_key = filtered_material, filtered_sales, filter_key
+
+    def cross_filtered(exclude=None):
+        return (
+            apply_cross_filters(base_key, '物料', base_material, cross_filters, exclude),
+            apply_cross_filters(base_key, '销售', base_sales, cross_filters, exclude),
+            cross_filter_key(base_key, cross_filters, exclude)
+        )
+
+    filtered_material, filtered_sales, filter_key = cross_filtered()
+    # 不经过上面的明细数据、直接读取分区或预汇总数据的分析，用联动筛选的区域代替侧边栏区域，并传入联动筛选的客户
+    view_regions = cross_filters.get('所属区域', selected_regions)
+    view_customers = cross_filters.get('客户代码')
+
+    # 去重计数：默认合并HyperLogLog草图，可切换为精确集合；按客户联动筛选时单元格无法表示，直接在明细上计数
+    exact_distinct = st.sidebar.toggle(
+        "精确去重计数", value=DISTINCT_MODE == 'exact',
+        help=f"关闭时客户数、物料种类数为HyperLogLog估计值（相对误差约{104 / 2 ** (HLL_PRECISION / 2):.1f}%）"
+    )
+    distinct = None
+    if not cross_filters.get('客户代码'):
+        distinct = DistinctCounter(snapshot, partition_names, filter_key, view_regions,
+                                   selected_provinces, start_date, end_date, exact=exact_distinct)
+
+    # 导出当前筛选条件下的明细数据
+    with st.sidebar.expander("导出明细数据"):
+        st.caption("物料明细")
+        export_buttons("物料明细", filtered_material, filter_key, key_prefix='sidebar_')
+        st.caption("销售明细")
+        export_buttons("销售明细", filtered_sales, filter_key, key_prefix='sidebar_')
 
     # 检查过滤后的数据是否为空
     if filtered_material.empty or filtered_sales.empty:
@@ -2004,40 +5238,131 @@ def main():
     overall_cost_sales_ratio = calculate_fee_ratio(total_material_cost, total_sales)
     avg_material_effectiveness = total_sales / filtered_material['物料数量'].sum() if filtered_material['物料数量'].sum() > 0 else 0
 
+    # 对比模式：本期与对比期拼接后按时期分组汇总一次
+    comparison = None
+    previous_kpis = None
+    if compare_range is not None:
+        compare_names = set(partition_names) | set(select_partitions(snapshot.registry, *compare_range))
+        compare_names = [name for name in snapshot.partition_names if name in compare_names]
+        compare_material, compare_sales, _ = snapshot.frames(compare_names)
+        if compare_material is not None:
+            # 联动筛选按行号索引作用于对比数据，本期与对比期的KPI口径一致
+            compare_key = make_filter_key(snapshot.dataset_version(compare_names))
+            compare_material = apply_cross_filters(compare_key, '物料', compare_material, cross_filters)
+            compare_sales = apply_cross_filters(compare_key, '销售', compare_sales, cross_filters)
+            comparison_key = cross_filter_key(make_filter_key(
+                snapshot.dataset_version(compare_names), selected_regions, selected_provinces, start_date, end_date
+            ), cross_filters)
+            comparison = analysis_result(
+                comparison_key, ('comparison', str(compare_range[0]), str(compare_range[1])),
+                lambda: compute_period_comparison(
+                    compare_material, compare_sales, selected_regions, selected_provinces,
+                    [('本期', start_date, end_date), ('对比期', compare_range[0], compare_range[1])]
+                )
+            )
+            overall = comparison[0].iloc[0]
+            previous_kpis = (
+                overall['物料总成本_对比期'],
+                overall['销售总额_对比期'],
+                overall['费比_对比期'],
+                overall['销售总额_对比期'] / overall['物料数量_对比期'] if overall['物料数量_对比期'] > 0 else 0
+            )
+
     # 显示KPI卡片
-    display_kpi_cards(total_material_cost, total_sales, overall_cost_sales_ratio, avg_material_effectiveness)
+    display_kpi_cards(total_material_cost, total_sales, overall_cost_sales_ratio, avg_material_effectiveness,
+                      previous_kpis)
+
+    # 异常提醒（按数据版本缓存，筛选条件只影响显示哪些条目）
+    anomalies = analysis_result(
+        make_filter_key(snapshot.dataset_version(partition_names)), 'anomalies',
+        lambda: detect_anomalies(df_material, df_sales)
+    )
+    display_anomaly_alerts(anomalies, view_regions, selected_provinces, start_date, end_date, view_customers)
 
     # 创建分析选项卡
-    tabs = st.tabs([
+    tab_names = [
         "区域分析",
         "时间趋势",
         "客户价值",
         "物料效益",
-        "物料-产品关联"
-    ])
+        "物料-产品关联",
+        "预算优化",
+        "透视分析",
+        "数据质量"
+    ]
+    if comparison is not None:
+        tab_names.append("时期对比")
+    tabs = st.tabs(tab_names)
 
     # 渲染各个选项卡
     with tabs[0]:
-        # 先执行原有的区域分析
-        region_analysis(filtered_material, filtered_sales)
+        # 先执行原有的区域分析（不按自身的区域选择筛选）
+        region_analysis(*cross_filtered(exclude='所属区域'))
 
         # 添加一个分隔符
         st.markdown("---")
 
         # 再执行申请人使用物料效率分析
-        applicant_material_efficiency_analysis(filtered_material, filtered_sales)
+        applicant_material_efficiency_analysis(filtered_material, filtered_sales, filter_key, distinct)
 
     with tabs[1]:
-        time_analysis(filtered_material, filtered_sales)
+        time_analysis(filtered_material, filtered_sales, filter_key)
+
+        st.markdown("---")
+
+        # 多粒度趋势
+        time_series_analysis(snapshot, view_regions, selected_provinces, start_date, end_date, view_customers)
+
+        st.markdown("---")
+
+        # 跨年同比
+        year_over_year_analysis(snapshot, view_regions, selected_provinces, start_date, end_date, view_customers)
 
     with tabs[2]:
-        customer_analysis(filtered_material, filtered_sales)
+        # 客户价值分析不按自身的客户选择筛选
+        customer_analysis(*cross_filtered(exclude='客户代码'))
+
+        st.markdown("---")
+
+        # 客户同期群
+        customer_cohort_analysis(snapshot, view_regions, selected_provinces, start_date, end_date, view_customers)
+
+        st.markdown("---")
+
+        # 物料推荐
+        material_recommendation_analysis(filtered_material, filtered_sales, filter_key)
 
     with tabs[3]:
-        material_analysis(filtered_material, filtered_sales)
+        material_analysis(filtered_material, filtered_sales, filter_key)
+
+        st.markdown("---")
+
+        # 物料边际回报
+        marginal_roi_analysis(filtered_material, filtered_sales, filter_key)
 
     with tabs[4]:
-        material_product_analysis(filtered_material, filtered_sales)
+        material_product_analysis(filtered_material, filtered_sales, filter_key, distinct)
+
+        st.markdown("---")
+
+        # 衰减结转归因
+        adstock_analysis(filtered_material, filtered_sales, filter_key)
+
+    with tabs[5]:
+        budget_optimizer_analysis(filtered_material, filtered_sales, filter_key)
+
+    with tabs[6]:
+        pivot_analysis(snapshot, partition_names, base_key, selected_regions, selected_provinces, start_date, end_date)
+
+    with tabs[7]:
+        data_quality_analysis(snapshot, partition_names)
+
+    if comparison is not None:
+        with tabs[8]:
+            period_comparison_analysis(comparison, start_date, end_date, *compare_range, comparison_key)
+
+    # 显示缓存统计
+    display_cache_stats()
 
     # 添加页脚信息
     st.markdown("""
@@ -2048,6 +5373,108 @@ def main():
     """, unsafe_allow_html=True)
 
 
+# 启动前预热
+def run_warm_up():
+    """部署时在启动服务前执行 `python 物料分析.py --warmup`：解析数据、为全部分区写入列式存储并把各分区的派生数据
+    写入磁盘结果缓存，预先计算默认视图，完成后再启动streamlit，健康检查就绪时数据已经可用；
+    服务进程之后用到历史分区时只需映射列式存储"""
+    started = datetime.now()
+    refresher = get_data_refresher()
+    refresher.stop()
+    snapshot = refresher.snapshot()
+    if snapshot is None or any(snapshot.partition(name)[0] is None for name in snapshot.partition_names):
+        print("预热失败: 无法加载数据文件")
+        return 1
+    for name in snapshot.partition_names:
+        snapshot.prepare(name)
+
+    elapsed = (datetime.now() - started).total_seconds()
+    print(f"预热完成: {len(snapshot.partition_names)} 个分区，数据版本 {snapshot.version}，"
+          f"预计算 {len(snapshot.results)} 项分析，耗时 {elapsed:.1f} 秒")
+    return 0
+
+
+# 计算引擎一致性校验
+def run_engine_check():
+    """升级pandas/polars或修改分析代码后执行 `python 物料分析.py --check-engines`：对每个分区及全部分区的合并数据，
+    分别在不筛选和按各区域筛选时用两种引擎计算各项分析并比对结果，不一致时返回1，可在CI中运行"""
+    if not POLARS_AVAILABLE:
+        print("未安装polars，无法校验计算引擎一致性")
+        return 1
+    refresher = get_data_refresher()
+    refresher.stop()
+    snapshot = refresher.snapshot()
+    if snapshot is None:
+        print("校验失败: 无法读取数据集注册表")
+        return 1
+
+    failures = 0
+    combinations = [[name] for name in snapshot.partition_names]
+    if len(combinations) > 1:
+        combinations.append(snapshot.partition_names)
+    for names in combinations:
+        df_material, df_sales, _ = snapshot.frames(names)
+        label = '+'.join(names)
+        if df_material is None:
+            print(f"{label}: 无法加载数据文件")
+            failures += 1
+            continue
+        for region in [None] + sorted(df_material['所属区域'].dropna().unique()):
+            try:
+                check_engine_parity(df_material, df_sales, regions=None if region is None else [region])
+            except AssertionError as e:
+                print(f"{label} / {region or '全部区域'}: {e}")
+                failures += 1
+    print(f"计算引擎一致性校验{'失败' if failures else '通过'}: {len(snapshot.partition_names)} 个分区，"
+          f"{failures} 处不一致")
+    return 1 if failures else 0
+
+
+# 导入耗时分析
+def run_import_profile(budget_ms=None):
+    """在子进程中用 -X importtime 执行本脚本的模块体（不进入main），即打开页面到出现密码框前的准备工作，
+    列出耗时最多的顶层导入。脚本启动时直接导入了DEFERRED_MODULES中的模块或总耗时超过预算时返回1，可在CI中运行：
+    python 物料分析.py --profile-imports [预算毫秒]"""
+    code = f"import runpy; runpy.run_path({os.path.abspath(__file__)!r}, run_name='import_profile')"
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                               capture_output=True, text=True, encoding='utf-8', errors='replace')
+    wall_ms = (time.perf_counter() - started) * 1000
+    if completed.returncode != 0:
+        print(completed.stderr)
+        return 1
+
+    # 每行格式: import time: 自身耗时 | 累计耗时 | 模块名（缩进表示被其他模块间接导入）
+    top_level = []
+    for line in completed.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match and len(match.group(3)) == 1:
+            top_level.append((int(match.group(2)) / 1000, match.group(4)))
+
+    total_ms = sum(ms for ms, _ in top_level)
+    print(f"{'累计耗时(ms)':>12}  模块")
+    for ms, module in sorted(top_level, reverse=True)[:15]:
+        print(f"{ms:>12.1f}  {module}")
+    print(f"导入总耗时: {total_ms:.1f} ms，模块体执行总耗时(含解释器启动): {wall_ms:.1f} ms")
+
+    failed = False
+    early = sorted({module for _, module in top_level if module.split('.')[0] in DEFERRED_MODULES})
+    if early:
+        print(f"以下模块应延迟到首次使用时导入，但在启动时已被导入: {', '.join(early)}")
+        failed = True
+    if budget_ms is not None and total_ms > budget_ms:
+        print(f"导入总耗时超过预算 {budget_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
 # 运行应用
 if __name__ == "__main__":
+    if "--warmup" in sys.argv[1:]:
+        sys.exit(run_warm_up())
+    if "--check-engines" in sys.argv[1:]:
+        sys.exit(run_engine_check())
+    if "--profile-imports" in sys.argv[1:]:
+        args = sys.argv[sys.argv.index("--profile-imports") + 1:]
+        sys.exit(run_import_profile(float(args[0]) if args else None))
     main()
\ No newline at end of file